@@ -0,0 +1,357 @@
+"""
+WatermarkProcessor 性能基准测试
+
+生成 1MP 到 100MP、RGB/RGBA/L/P/CMYK 模式的合成图片，遍历文字/图片水印、
+重复模式开关、旋转角度和间距极值，记录每个用例的耗时、峰值内存和内存分配，
+结果保存为 JSON，并可与基线结果对比以发现性能回退。
+
+用法：
+    python benchmark.py run --sizes 1,4,12 -o results.json
+    python benchmark.py run --sizes 24,50,100 --modes RGB --filter text -o large.json
+    python benchmark.py compare baseline.json results.json --threshold 0.1
+    python benchmark.py startup --budget-ms 500
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+DEFAULT_SIZES = "1,4,12"
+ALL_MODES = "RGB,RGBA,L,P,CMYK"
+ANGLES = (0, -30)
+# 间距极值：界面允许的最小值和最大值
+SPACINGS = {"min": (50, 50), "max": (500, 300)}
+
+
+def build_cases(sizes, modes, pattern=None):
+    """
+    生成用例列表，每个用例是参数字典，name 字段唯一标识用例
+    """
+    cases = []
+    for megapixels in sizes:
+        for mode in modes:
+            for watermark_type in ("text", "image"):
+                for repeat in (True, False):
+                    for angle in ANGLES:
+                        spacing_names = SPACINGS if repeat else {"min": SPACINGS["min"]}
+                        for spacing_name, (spacing_x, spacing_y) in spacing_names.items():
+                            name = (
+                                f"{watermark_type}-{mode}-{megapixels:g}MP-"
+                                f"{'repeat' if repeat else 'single'}-a{angle}"
+                                + (f"-s{spacing_name}" if repeat else "")
+                            )
+                            if pattern and not re.search(pattern, name):
+                                continue
+                            cases.append({
+                                "name": name, "type": watermark_type, "mode": mode,
+                                "megapixels": megapixels, "repeat": repeat, "angle": angle,
+                                "spacing_x": spacing_x, "spacing_y": spacing_y,
+                            })
+    return cases
+
+
+def make_image(megapixels, mode, seed=0):
+    """
+    生成 4:3 的合成图片（渐变 + 噪声），保证每次运行内容一致
+    """
+    import numpy as np
+    from PIL import Image
+
+    width = int(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = int(megapixels * 1e6 / width)
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    # 先截断到 0-255 再转换：超出范围的浮点数转为 uint8 的结果与平台有关
+    base = np.clip(gradient + rng.integers(0, 32, (height, 1), dtype=np.uint8), 0, 255).astype(np.uint8)
+    rgb = np.stack([base, base[::-1], np.roll(base, width // 3, axis=1)], axis=2)
+    image = Image.fromarray(rgb)
+    if mode == "RGB":
+        return image
+    if mode == "P":
+        return image.quantize(64)
+    return image.convert(mode)
+
+
+def make_logo():
+    import numpy as np
+    from PIL import Image
+
+    logo = np.zeros((200, 400, 4), dtype=np.uint8)
+    logo[..., 0] = 255
+    logo[..., 2] = np.linspace(0, 255, 400, dtype=np.uint8)[None, :]
+    logo[40:160, 40:360, 3] = 255
+    return Image.fromarray(logo, "RGBA")
+
+
+def _run_once(watermark_app, image, logo, case):
+    watermark_type = "文字水印" if case["type"] == "text" else "图片水印"
+    start = time.perf_counter()
+    result, status = watermark_app.process_watermark(
+        image, watermark_type, "© WATERMARK 版权保护", 40, "#FF4757",
+        logo if case["type"] == "image" else None, 100, 100, 0.4, case["angle"], 0.2,
+        case["repeat"], case["spacing_x"], case["spacing_y"]
+    )
+    elapsed = time.perf_counter() - start
+    if status != "水印添加成功！":
+        raise RuntimeError(status)
+    return elapsed
+
+
+def peak_rss_mb():
+    """
+    当前进程的峰值常驻内存（MB），无法获取时（如 Windows 没有 resource 模块）返回 None
+
+    ru_maxrss 在 Linux 上以 KB 为单位，在 macOS 上以字节为单位。
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _case_worker(case, repeats, connection):
+    """
+    在独立子进程中执行一个用例，使峰值内存只反映该用例
+    """
+    try:
+        import watermark_app
+
+        image = make_image(case["megapixels"], case["mode"])
+        image.load()
+        logo = make_logo()
+        rss_before = peak_rss_mb()
+
+        # 冷启动：覆盖层缓存为空
+        watermark_app.processor.overlay_cache.clear()
+        cold = _run_once(watermark_app, image, logo, case)
+        warm = [_run_once(watermark_app, image, logo, case) for _ in range(repeats)]
+        rss_after = peak_rss_mb()
+
+        # 单独运行一次统计 Python/NumPy 内存分配（tracemalloc 会拖慢执行，不计入耗时）
+        tracemalloc.start()
+        _run_once(watermark_app, image, logo, case)
+        _, traced_peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        connection.send({
+            "wall_cold_s": cold,
+            "wall_warm_s": statistics.median(warm) if warm else cold,
+            "wall_min_s": min(warm) if warm else cold,
+            "peak_rss_mb": rss_after,
+            "rss_delta_mb": rss_after - rss_before if rss_after is not None else None,
+            "alloc_peak_mb": traced_peak / (1024 * 1024),
+            "alloc_live_blocks": sum(stat.count for stat in snapshot.statistics("filename")),
+            "width": image.width,
+            "height": image.height,
+        })
+    except Exception as e:
+        connection.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        connection.close()
+
+
+def run_case(case, repeats, context):
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=_case_worker, args=(case, repeats, child))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {"error": f"子进程异常退出（exit code {process.exitcode}）"}
+    process.join()
+    return result
+
+
+def environment_info():
+    import cv2
+    import numpy
+    import PIL
+
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=False
+        ).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": numpy.__version__,
+        "pillow": PIL.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def command_run(args) -> int:
+    sizes = [float(s) for s in args.sizes.split(",") if s]
+    modes = [m.strip().upper() for m in args.modes.split(",") if m.strip()]
+    cases = build_cases(sizes, modes, args.filter)
+    if not cases:
+        print("没有匹配的用例")
+        return 1
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    print(f"共 {len(cases)} 个用例，每个用例预热后重复 {args.repeats} 次")
+    for index, case in enumerate(cases, 1):
+        result = run_case(case, args.repeats, context)
+        results[case["name"]] = dict(case, **result)
+        if "error" in result:
+            print(f"[{index}/{len(cases)}] {case['name']:<40} 失败：{result['error']}")
+        else:
+            rss = result["rss_delta_mb"]
+            print(
+                f"[{index}/{len(cases)}] {case['name']:<40} "
+                f"冷 {result['wall_cold_s'] * 1000:9.1f} ms  热 {result['wall_warm_s'] * 1000:9.1f} ms  "
+                f"RSS {f'+{rss:7.1f} MB' if rss is not None else '       n/a'}  "
+                f"分配峰值 {result['alloc_peak_mb']:7.1f} MB"
+            )
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"environment": environment_info(), "cases": results}, f, indent=2, ensure_ascii=False)
+    print(f"结果已保存到 {args.output}")
+    return 0
+
+
+# 对比的指标：(字段, 显示名称)
+COMPARED_METRICS = (
+    ("wall_warm_s", "耗时"),
+    ("wall_cold_s", "冷启动耗时"),
+    ("rss_delta_mb", "RSS 增量"),
+    ("alloc_peak_mb", "分配峰值"),
+)
+
+
+def command_compare(args) -> int:
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)["cases"]
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)["cases"]
+
+    regressions = improvements = 0
+    common = [name for name in baseline if name in current]
+    for name in common:
+        before, after = baseline[name], current[name]
+        if "error" in before or "error" in after:
+            continue
+        for key, label in COMPARED_METRICS:
+            old, new = before.get(key), after.get(key)
+            if old is None or new is None:
+                continue
+            # 过小的数值噪声大，不参与判断
+            floor = args.min_seconds if key.startswith("wall") else args.min_mb
+            if max(old, new) < floor:
+                continue
+            ratio = new / old if old > 0 else math.inf
+            if ratio > 1 + args.threshold:
+                regressions += 1
+                print(f"回退  {name:<40} {label:<8} {old:10.4f} -> {new:10.4f}  ({(ratio - 1) * 100:+.1f}%)")
+            elif ratio < 1 - args.threshold:
+                improvements += 1
+                if args.verbose:
+                    print(f"改进  {name:<40} {label:<8} {old:10.4f} -> {new:10.4f}  ({(ratio - 1) * 100:+.1f}%)")
+
+    missing = sorted(set(baseline) - set(current))
+    if missing:
+        print(f"当前结果缺少 {len(missing)} 个基线用例")
+    print(f"对比 {len(common)} 个用例：{regressions} 项回退，{improvements} 项改进（阈值 {args.threshold:.0%}）")
+    return 1 if regressions else 0
+
+
+# 在全新解释器中导入处理核心并预热，输出耗时和已加载的可选重型模块
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import watermark_app
+imported = time.perf_counter() - start
+warm_up = watermark_app.warm_up()
+print(json.dumps({
+    "import_s": imported,
+    "warm_up_s": warm_up,
+    "heavy_modules": sorted(m for m in ("gradio", "http.server", "tifffile", "sqlite3") if m in sys.modules),
+}))
+"""
+
+
+def command_startup(args) -> int:
+    """
+    测量 import watermark_app 和预热的耗时，超出预算或导入了可选重型模块时返回 1
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    # 第一次运行会生成字节码缓存，不计入结果
+    for index in range(args.repeats + 1):
+        completed = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], capture_output=True,
+                                   text=True, cwd=root, check=False)
+        if completed.returncode != 0:
+            print(completed.stderr)
+            return 1
+        if index:
+            samples.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    import_ms = statistics.median(sample["import_s"] for sample in samples) * 1000
+    warm_up_ms = statistics.median(sample["warm_up_s"] for sample in samples) * 1000
+    heavy = sorted({module for sample in samples for module in sample["heavy_modules"]})
+    print(f"导入 {import_ms:.0f} ms（预算 {args.budget_ms:.0f} ms），预热 {warm_up_ms:.0f} ms")
+    if heavy:
+        print(f"导入处理核心时加载了可选模块：{', '.join(heavy)}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"environment": environment_info(), "import_ms": import_ms, "warm_up_ms": warm_up_ms,
+                       "heavy_modules": heavy, "samples": samples}, f, indent=2, ensure_ascii=False)
+    return 1 if heavy or import_ms > args.budget_ms else 0
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="WatermarkProcessor 性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="运行基准测试")
+    run.add_argument("--sizes", default=DEFAULT_SIZES, help="图片大小（百万像素），逗号分隔，如 1,4,12,24,50,100")
+    run.add_argument("--modes", default=ALL_MODES, help="图像模式，逗号分隔")
+    run.add_argument("--filter", help="只运行名称匹配该正则的用例")
+    run.add_argument("--repeats", type=int, default=3, help="预热后的重复次数，取中位数")
+    run.add_argument("-o", "--output", default="benchmark_results.json", help="结果 JSON 路径")
+
+    compare = subparsers.add_parser("compare", help="与基线结果对比，发现回退时返回非零退出码")
+    compare.add_argument("baseline", help="基线结果 JSON")
+    compare.add_argument("current", help="当前结果 JSON")
+    compare.add_argument("--threshold", type=float, default=0.10, help="判定回退的相对变化阈值")
+    compare.add_argument("--min-seconds", type=float, default=0.005, help="低于该耗时（秒）的用例不参与判断")
+    compare.add_argument("--min-mb", type=float, default=1.0, help="低于该内存（MB）的指标不参与判断")
+    compare.add_argument("-v", "--verbose", action="store_true", help="同时列出改进项")
+
+    startup = subparsers.add_parser("startup", help="测量处理核心的导入和预热耗时，超出预算时返回非零退出码")
+    startup.add_argument("--budget-ms", type=float, default=500, help="import watermark_app 的耗时预算（毫秒，取中位数）")
+    startup.add_argument("--repeats", type=int, default=5, help="重复次数")
+    startup.add_argument("-o", "--output", help="结果 JSON 路径")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_arg_parser().parse_args(argv)
+    if args.command == "run":
+        return command_run(args)
+    if args.command == "startup":
+        return command_startup(args)
+    return command_compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
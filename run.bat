@@ -20,9 +20,9 @@ REM 激活虚拟环境
 echo 🔄 激活虚拟环境...
 call watermark_env\Scripts\activate.bat
 
-REM 检查依赖是否安装
+REM 检查依赖是否安装（只查找模块，不导入）
 echo 📦 检查依赖...
-python -c "import cv2, gradio, PIL, numpy" 2>nul
+python -c "import importlib.util, sys; sys.exit(any(importlib.util.find_spec(m) is None for m in ('cv2', 'gradio', 'PIL', 'numpy')))" 2>nul
 if errorlevel 1 (
     echo 📥 安装依赖包...
     pip install -r requirements.txt
@@ -33,5 +33,5 @@ echo 💡 应用启动后请在浏览器中访问: http://localhost:7860
 echo ⏹️ 按 Ctrl+C 停止应用
 echo.
 
-python watermark_app.py
+python -m watermark_app %*
 pause
\ No newline at end of file
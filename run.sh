@@ -18,9 +18,9 @@ fi
 echo "🔄 激活虚拟环境..."
 source watermark_env/bin/activate
 
-# 检查依赖是否安装
+# 检查依赖是否安装（只查找模块，不导入，避免每次启动都加载一遍 Gradio）
 echo "📦 检查依赖..."
-if ! python -c "import cv2, gradio, PIL, numpy" 2>/dev/null; then
+if ! python -c "import importlib.util, sys; sys.exit(any(importlib.util.find_spec(m) is None for m in ('cv2', 'gradio', 'PIL', 'numpy')))" 2>/dev/null; then
     echo "📥 安装依赖包..."
     pip3 install -r requirements.txt
 fi
@@ -30,4 +30,5 @@ echo "💡 应用启动后请在浏览器中访问: http://localhost:7860"
 echo "⏹️ 按 Ctrl+C 停止应用"
 echo ""
 
-python3 watermark_app.py 
\ No newline at end of file
+# exec 使应用直接作为服务主进程（可向 systemd 报告就绪）；-m 运行时会复用编译好的字节码
+exec python3 -m watermark_app "$@"
@@ -1,79 +1,928 @@
 import cv2
 import numpy as np
-import gradio as gr
 from PIL import Image, ImageDraw, ImageFont
+import argparse
+import atexit
+import hashlib
 import io
+import logging
+import multiprocessing
 import os
-from typing import Optional, Tuple
+import queue
+import re
+import select
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from collections import OrderedDict, deque
+from contextlib import contextmanager, suppress
+from typing import TYPE_CHECKING, NamedTuple, Optional, Tuple
 
-class WatermarkProcessor:
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+logger = logging.getLogger("watermark")
+
+
+def env_number(name: str, default, cast=int, minimum=None, maximum=None):
+    """
+    读取数值型环境变量，未设置时返回 default
+
+    无法解析或超出 [minimum, maximum] 时记录警告并返回 default，配置错误不会导致导入或启动失败。
+    """
+    raw = os.environ.get(name, "").strip()
+    if not raw:
+        return default
+    try:
+        value = cast(raw)
+    except ValueError:
+        logger.warning("环境变量 %s=%r 不是有效的数值，使用默认值 %s", name, raw, default)
+        return default
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        logger.warning("环境变量 %s=%s 超出范围 [%s, %s]，使用默认值 %s", name, raw,
+                       "" if minimum is None else minimum, "" if maximum is None else maximum, default)
+        return default
+    return value
+
+
+# ---------------------------------------------------------------------------
+# 性能指标（各阶段耗时直方图，Prometheus 文本格式）
+# ---------------------------------------------------------------------------
+
+class StageMetrics:
+    """
+    记录各处理阶段耗时的直方图
+
+    阶段包括 decode、convert、font_load、overlay_render、composite、encode。
+    工作进程中的任务用 capture() 收集本次观测值，交回主进程用 observe_many() 汇总。
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    
     def __init__(self):
-        self.supported_formats = ['.jpg', '.jpeg', '.png', '.tiff', '.tif', '.bmp', '.webp']
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._local = threading.local()
+    
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+    
+    def observe(self, stage: str, seconds: float) -> None:
+        if getattr(self._local, 'paused', False):
+            return
+        captured = getattr(self._local, 'captured', None)
+        if captured is not None:
+            captured.append((stage, seconds))
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                # 各桶计数（累计）、总和、次数
+                histogram = self._histograms[stage] = [[0] * len(self.BUCKETS), 0.0, 0]
+            buckets = histogram[0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+    
+    def observe_many(self, observations) -> None:
+        for stage, seconds in observations:
+            self.observe(stage, seconds)
+    
+    @contextmanager
+    def capture(self, captured: Optional[list] = None):
+        """
+        收集当前线程在代码块内的观测值；传入 captured 时追加到该列表，
+        用于把线程池中的观测值并入调用方正在进行的收集
+        """
+        captured = [] if captured is None else captured
+        previous = getattr(self._local, 'captured', None)
+        self._local.captured = captured
+        try:
+            yield captured
+        finally:
+            self._local.captured = previous
+    
+    @contextmanager
+    def paused(self):
+        """
+        代码块内当前线程的观测值不计入统计（如启动预热）
+        """
+        previous = getattr(self._local, 'paused', False)
+        self._local.paused = True
+        try:
+            yield
+        finally:
+            self._local.paused = previous
+    
+    def current_capture(self) -> Optional[list]:
+        """
+        返回当前线程正在进行的收集列表，没有时返回 None
+        """
+        return getattr(self._local, 'captured', None)
+    
+    def summary(self) -> dict:
+        """
+        返回 {阶段: (次数, 总耗时)}
+        """
+        with self._lock:
+            return {stage: (h[2], h[1]) for stage, h in self._histograms.items()}
+    
+    def render(self, gauges: Optional[dict] = None) -> str:
+        """
+        以 Prometheus 文本格式输出直方图，gauges 为附加的 {指标名: 值}
+        """
+        lines = [
+            "# HELP watermark_stage_seconds Time spent in each watermark processing stage.",
+            "# TYPE watermark_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage in sorted(self._histograms):
+                buckets, total, count = self._histograms[stage]
+                for bound, value in zip(self.BUCKETS, buckets):
+                    lines.append(f'watermark_stage_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {value}')
+                lines.append(f'watermark_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'watermark_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+                lines.append(f'watermark_stage_seconds_count{{stage="{stage}"}} {count}')
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = StageMetrics()
+
+
+def run_profiled(name: str, fn, *args):
+    """
+    设置了环境变量 WATERMARK_PROFILE_DIR 时，用 cProfile 记录本次调用并写入该目录
+    """
+    profile_dir = os.environ.get("WATERMARK_PROFILE_DIR")
+    if not profile_dir:
+        return fn(*args)
+    
+    import cProfile
+    
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args)
+    finally:
+        os.makedirs(profile_dir, exist_ok=True)
+        filename = f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.prof"
+        profiler.dump_stats(os.path.join(profile_dir, filename))
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0", gauges=None) -> 'ThreadingHTTPServer':
+    """
+    在后台线程中提供 /metrics 接口，gauges 为返回附加指标字典的可调用对象
+    """
+    # 只在开启指标接口时导入 http.server（连带导入 email、html 等模块）
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render(gauges() if gauges else None).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("metrics: %s", format % args)
+    
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("指标接口：http://%s:%d/metrics", host, port)
+    return server
+
+
+def configure_logging(level: str = "WARNING") -> None:
+    logging.basicConfig(
+        level=getattr(logging, str(level).upper(), logging.WARNING),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+
+# 候选字体路径，优先选择支持中文的字体
+DEFAULT_FONT_PATHS = [
+    # macOS 中文字体
+    "/System/Library/Fonts/PingFang.ttc",
+    "/System/Library/Fonts/STHeiti Light.ttc",
+    "/System/Library/Fonts/Hiragino Sans GB.ttc",
+    "/Library/Fonts/Arial Unicode MS.ttf",
+    # Linux 中文字体
+    "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+    # Windows 中文字体
+    "C:/Windows/Fonts/msyh.ttc",  # 微软雅黑
+    "C:/Windows/Fonts/simhei.ttf",  # 黑体
+    "C:/Windows/Fonts/simsun.ttc",  # 宋体
+    # 英文字体备选
+    "/System/Library/Fonts/Arial.ttf",  # macOS
+    "/System/Library/Fonts/Helvetica.ttc",  # macOS
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # Linux
+    "arial.ttf",  # Windows
+    "C:/Windows/Fonts/arial.ttf"  # Windows 绝对路径
+]
+
+
+class FontRegistry:
+    """
+    字体注册表：启动时解析一次字体路径，并按 (路径, 字号) 缓存已加载的字体
+
+    可通过环境变量 WATERMARK_FONT 指定字体文件，未指定或不可用时按
+    DEFAULT_FONT_PATHS 顺序查找，全部失败则使用 Pillow 默认字体。
+    """
+    def __init__(self, font_path: Optional[str] = None, max_fonts: int = 32):
+        self.max_fonts = max_fonts
+        self._fonts = OrderedDict()
+        self._lock = threading.Lock()
+        self.font_path = self.resolve_font_path(font_path or os.environ.get("WATERMARK_FONT"))
+    
+    def resolve_font_path(self, preferred: Optional[str] = None) -> Optional[str]:
+        """
+        解析可用的字体路径，返回 None 表示使用默认字体
+        """
+        candidates = ([preferred] if preferred else []) + DEFAULT_FONT_PATHS
+        for font_path in candidates:
+            if os.path.exists(font_path):
+                try:
+                    ImageFont.truetype(font_path, 10)
+                    logger.info("使用字体：%s", font_path)
+                    return font_path
+                except Exception as e:
+                    logger.warning("字体加载失败 %s: %s", font_path, e)
+                    continue
+            elif font_path == preferred:
+                logger.warning("配置的字体不存在：%s", font_path)
+        
+        logger.warning("使用默认字体")
+        return None
+    
+    def get_font(self, font_size: int, font_path: Optional[str] = None):
+        """
+        获取指定字号的字体对象，命中缓存时不再重复解析字体文件
+        """
+        font_path = font_path or self.font_path
+        key = (font_path, font_size)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                return font
+        
+        with metrics.time("font_load"):
+            try:
+                if font_path is None:
+                    font = ImageFont.load_default()
+                else:
+                    font = ImageFont.truetype(font_path, font_size)
+            except Exception as e:
+                font = ImageFont.load_default()
+                logger.warning("字体加载异常：%s, 使用默认字体", e)
+        
+        with self._lock:
+            self._fonts[key] = font
+            self._fonts.move_to_end(key)
+            while len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+        return font
+
+
+class PreparedOverlay:
+    """
+    可直接混合的预乘覆盖层：premultiplied 为 颜色×alpha/255（RGB），alpha 为单通道
+    """
+    __slots__ = ('premultiplied', 'alpha')
+    
+    # 分块混合的行数，限制临时 uint16 缓冲区的大小
+    BLEND_ROWS = 256
+    
+    def __init__(self, premultiplied: np.ndarray, alpha: np.ndarray):
+        self.premultiplied = premultiplied
+        self.alpha = alpha
+    
+    @classmethod
+    def from_rgba(cls, rgba: np.ndarray) -> 'PreparedOverlay':
+        """
+        由非预乘的 RGBA 数组构建
+        """
+        alpha = rgba[..., 3:4]
+        premultiplied = ((rgba[..., :3].astype(np.uint16) * alpha + 127) // 255).astype(np.uint8)
+        return cls(premultiplied, np.ascontiguousarray(alpha))
+    
+    @property
+    def nbytes(self) -> int:
+        return self.premultiplied.nbytes + self.alpha.nbytes
+    
+    def resized(self, width: int, height: int) -> 'PreparedOverlay':
+        """
+        缩放到指定尺寸（预乘数据可以直接插值）
+        """
+        width, height = max(1, width), max(1, height)
+        rgba = np.concatenate([self.premultiplied, self.alpha], axis=2)
+        rgba = cv2.resize(rgba, (width, height), interpolation=cv2.INTER_AREA)
+        return PreparedOverlay(rgba[..., :3], rgba[..., 3:4])
+    
+    def blend(self, image: np.ndarray) -> np.ndarray:
+        """
+        将覆盖层原地混合到 RGB uint8 图像上并返回该图像：
+        result = premultiplied + image × (255 - alpha) / 255
+
+        使用定点整数运算（x / 255 ≈ (t + (t >> 8)) >> 8，t = x + 128，
+        对 0..65025 精确舍入），按行分块以限制临时内存。
+        """
+        blend_premultiplied(image, self.premultiplied, self.alpha, self.BLEND_ROWS)
+        return image
+    
+    def blend_region(self, dst: np.ndarray, x0: int = 0, y0: int = 0) -> np.ndarray:
+        """
+        原地混合 dst，dst 的左上角位于覆盖层坐标 (x0, y0)
+        """
+        height, width = dst.shape[:2]
+        region = (slice(y0, y0 + height), slice(x0, x0 + width))
+        blend_premultiplied(dst, self.premultiplied[region], self.alpha[region], self.BLEND_ROWS)
+        return dst
+
+
+def blend_premultiplied(dst: np.ndarray, premultiplied: np.ndarray, alpha: np.ndarray,
+                        block_rows: int = 256) -> None:
+    """
+    原地执行 dst = premultiplied + dst × (255 - alpha) / 255，三者高宽一致
+    """
+    height = dst.shape[0]
+    for y in range(0, height, block_rows):
+        rows = slice(y, y + block_rows)
+        work = dst[rows].astype(np.uint16)
+        work *= 255 - alpha[rows]
+        work += 128
+        work += work >> 8
+        work >>= 8
+        work += premultiplied[rows]
+        dst[rows] = work
+
+
+def tile_array(cell: np.ndarray, x0: int, y0: int, width: int, height: int) -> np.ndarray:
+    """
+    将周期单元平铺成 height × width 的区域，区域左上角对应画布坐标 (x0, y0)
+    """
+    period_h, period_w = cell.shape[:2]
+    cell = np.roll(cell, (-(y0 % period_h), -(x0 % period_w)), axis=(0, 1))
+    reps = (height // period_h + 1, width // period_w + 1) + (1,) * (cell.ndim - 2)
+    return np.tile(cell, reps)[:height, :width]
+
+
+class TiledOverlay:
+    """
+    周期平铺的覆盖层：只保存一个周期单元，混合任意区域时按画布坐标取模平铺，
+    因此分块处理时网格在块与块之间保持连续
+    """
+    __slots__ = ('cell',)
+    
+    def __init__(self, cell: PreparedOverlay):
+        self.cell = cell
+    
+    @property
+    def nbytes(self) -> int:
+        return self.cell.nbytes
+    
+    def band(self, x0: int, width: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        横向平铺出一条周期高度的带 (premultiplied, alpha)，带的左端位于画布横坐标 x0
+        """
+        period_h = self.cell.alpha.shape[0]
+        return (tile_array(self.cell.premultiplied, x0, 0, width, period_h),
+                tile_array(self.cell.alpha, x0, 0, width, period_h))
+    
+    def blend_region(self, dst: np.ndarray, x0: int = 0, y0: int = 0) -> np.ndarray:
+        """
+        原地混合 dst，dst 的左上角位于画布坐标 (x0, y0)
+        """
+        return self.blend_band(dst, self.band(x0, dst.shape[1]), y0)
+    
+    def blend_band(self, dst: np.ndarray, band: Tuple[np.ndarray, np.ndarray], y0: int = 0) -> np.ndarray:
+        """
+        用 band() 生成的横向周期带原地混合 dst，dst 的首行位于画布纵坐标 y0（按纵向取模取行）
+        """
+        height = dst.shape[0]
+        premultiplied_band, alpha_band = band
+        period_h = alpha_band.shape[0]
+        block_rows = PreparedOverlay.BLEND_ROWS
+        for y in range(0, height, block_rows):
+            rows = min(block_rows, height - y)
+            band_rows = (y0 + y + np.arange(rows)) % period_h
+            blend_premultiplied(dst[y:y + rows], premultiplied_band[band_rows],
+                                alpha_band[band_rows], block_rows)
+        return dst
+    
+    def scaled(self, factor_x: float, factor_y: float) -> 'ScaledTiledOverlay':
+        """
+        返回按比例缩放后的水印层，用于在缩小的预览图上混合
+        """
+        period_h, period_w = self.cell.alpha.shape[:2]
+        cell = self.cell.resized(round(period_w * factor_x), round(period_h * factor_y))
+        return ScaledTiledOverlay(cell, period_w, period_h, factor_x, factor_y)
+
+
+class ScaledTiledOverlay:
+    """
+    缩放后的平铺覆盖层：缩放后的周期一般不是整数像素，按原图坐标取模后重采样，
+    避免逐个周期取整造成网格漂移
+    """
+    __slots__ = ('cell', 'period_w', 'period_h', 'factor_x', 'factor_y')
+    
+    def __init__(self, cell: PreparedOverlay, period_w: int, period_h: int,
+                 factor_x: float, factor_y: float):
+        self.cell = cell
+        self.period_w = period_w
+        self.period_h = period_h
+        self.factor_x = factor_x
+        self.factor_y = factor_y
+    
+    def _cell_coordinates(self, start, count, factor, period, cell_size):
+        # 目标像素中心 -> 原图坐标 -> 周期内坐标 -> 缩放后单元内坐标
+        source = (np.arange(start, start + count) + 0.5) / factor - 0.5
+        return (((source % period) + 0.5) * (cell_size / period) - 0.5).astype(np.float32)
+    
+    def blend_region(self, dst: np.ndarray, x0: int = 0, y0: int = 0) -> np.ndarray:
+        height, width = dst.shape[:2]
+        cell_h, cell_w = self.cell.alpha.shape[:2]
+        map_x = self._cell_coordinates(x0, width, self.factor_x, self.period_w, cell_w)
+        map_y = self._cell_coordinates(y0, height, self.factor_y, self.period_h, cell_h)
+        map_x, map_y = np.meshgrid(map_x, map_y)
+        
+        rgba = np.concatenate([self.cell.premultiplied, self.cell.alpha], axis=2)
+        sampled = cv2.remap(rgba, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_WRAP)
+        blend_premultiplied(dst, sampled[..., :3], sampled[..., 3:4], PreparedOverlay.BLEND_ROWS)
+        return dst
+
+
+class PlacedOverlay:
+    """
+    放置在画布 (x, y) 处的局部覆盖层，混合时只处理与目标区域相交的部分
+    """
+    __slots__ = ('overlay', 'x', 'y')
+    
+    def __init__(self, overlay: PreparedOverlay, x: int, y: int):
+        self.overlay = overlay
+        self.x = x
+        self.y = y
+    
+    @property
+    def nbytes(self) -> int:
+        return self.overlay.nbytes
+    
+    def blend_region(self, dst: np.ndarray, x0: int = 0, y0: int = 0) -> np.ndarray:
+        """
+        原地混合 dst，dst 的左上角位于画布坐标 (x0, y0)
+        """
+        overlay_h, overlay_w = self.overlay.alpha.shape[:2]
+        left = max(self.x, x0)
+        top = max(self.y, y0)
+        right = min(self.x + overlay_w, x0 + dst.shape[1])
+        bottom = min(self.y + overlay_h, y0 + dst.shape[0])
+        if right <= left or bottom <= top:
+            return dst
+        
+        source = (slice(top - self.y, bottom - self.y), slice(left - self.x, right - self.x))
+        blend_premultiplied(
+            dst[top - y0:bottom - y0, left - x0:right - x0],
+            self.overlay.premultiplied[source],
+            self.overlay.alpha[source]
+        )
+        return dst
+    
+    def scaled(self, factor_x: float, factor_y: float) -> 'PlacedOverlay':
+        """
+        返回按比例缩放后的水印层，用于在缩小的预览图上混合
+        """
+        overlay_h, overlay_w = self.overlay.alpha.shape[:2]
+        return PlacedOverlay(
+            self.overlay.resized(round(overlay_w * factor_x), round(overlay_h * factor_y)),
+            round(self.x * factor_x), round(self.y * factor_y)
+        )
+
+
+# 条带并行：大图按水平条带在线程池中处理。NumPy 的逐元素运算、OpenCV 和 Pillow 的转换
+# 处理大块数据时都会释放 GIL，条带互不重叠，可以原地写入同一个缓冲区。
+# 像素数低于该值的图像不拆分，线程调度的开销大于收益
+PARALLEL_MIN_PIXELS = 2_000_000
+
+_strip_executor = None
+_strip_executor_key = None
+_strip_executor_lock = threading.Lock()
+
+
+def composite_threads() -> int:
+    """
+    条带并行的线程数（环境变量 WATERMARK_COMPOSITE_THREADS，默认 CPU 核数），1 表示不并行
+    """
+    return max(1, env_number("WATERMARK_COMPOSITE_THREADS", os.cpu_count() or 1))
+
+
+def _get_strip_executor(threads: int) -> ThreadPoolExecutor:
+    global _strip_executor, _strip_executor_key
+    # fork 出的子进程不继承线程，按进程号重新创建
+    key = (os.getpid(), threads)
+    with _strip_executor_lock:
+        if _strip_executor_key != key:
+            if _strip_executor is not None and _strip_executor_key[0] == key[0]:
+                _strip_executor.shutdown(wait=False)
+            _strip_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="watermark-strip")
+            _strip_executor_key = key
+        return _strip_executor
+
+
+def run_strips(height: int, width: int, work, threads: Optional[int] = None, min_rows: int = 64) -> None:
+    """
+    把 [0, height) 行分成水平条带，在线程池中并行执行 work(top, bottom)
+
+    小图或只有一个线程时直接在当前线程执行整幅图像。
+    """
+    threads = threads or composite_threads()
+    if threads <= 1 or height * width < PARALLEL_MIN_PIXELS or height < 2 * min_rows:
+        work(0, height)
+        return
+    # 每个线程分到多个条带，平衡条带之间的负载差异（如单个水印只覆盖其中几条）
+    step = max(min_rows, -(-height // (threads * 4)))
+    executor = _get_strip_executor(threads)
+    futures = [executor.submit(work, top, min(top + step, height)) for top in range(0, height, step)]
+    for future in futures:
+        future.result()
+
+
+def blend_layer(layer, dst: np.ndarray, x0: int = 0, y0: int = 0, threads: Optional[int] = None) -> np.ndarray:
+    """
+    按水平条带并行地把水印层原地混合到 dst，dst 的左上角位于画布坐标 (x0, y0)
+    """
+    if isinstance(layer, TiledOverlay):
+        # 横向平铺的周期带由所有条带共用，只生成一次
+        band = layer.band(x0, dst.shape[1])
+        
+        def work(top, bottom):
+            layer.blend_band(dst[top:bottom], band, y0 + top)
+    else:
+        def work(top, bottom):
+            layer.blend_region(dst[top:bottom], x0, y0 + top)
+    run_strips(dst.shape[0], dst.shape[1], work, threads)
+    return dst
+
+
+class OverlayCache:
+    """
+    按字节预算淘汰的覆盖层 LRU 缓存，并统计命中/未命中次数
+
+    预算可通过环境变量 WATERMARK_OVERLAY_CACHE_MB 配置（默认 256MB），
+    设为 0 时关闭缓存。
+    """
+    def __init__(self, max_bytes: Optional[int] = None):
+        if max_bytes is None:
+            max_bytes = int(env_number("WATERMARK_OVERLAY_CACHE_MB", 256.0, float, minimum=0) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    
+    def put(self, key, entry) -> None:
+        size = entry.nbytes
+        if size > self.max_bytes:
+            # 单个条目超过预算时不缓存
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes
+            self._entries[key] = entry
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class LogoRegistry:
+    """
+    水印图片注册表：按内容指纹缓存解码后的 RGBA 数组，以及按 (目标宽度, 角度) 缩放、旋转后的变体
+
+    同一个 logo 无论以路径、PIL 图像还是数组传入，都只保留一份解码结果。解码结果和变体共用
+    一个按字节预算淘汰的缓存，预算可通过环境变量 WATERMARK_LOGO_CACHE_MB 配置（默认 64MB）。
+    路径到指纹的映射只保留最近使用的 path_limit 条（Web 上传的每个 logo 都是新的临时路径）。
+    """
+    def __init__(self, max_bytes: Optional[int] = None, path_limit: int = 256):
+        if max_bytes is None:
+            max_bytes = int(env_number("WATERMARK_LOGO_CACHE_MB", 64.0, float, minimum=0) * 1024 * 1024)
+        self.cache = OverlayCache(max_bytes)
+        self.path_limit = path_limit
+        self._path_digests = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def fingerprint(rgba: np.ndarray) -> str:
+        """
+        计算水印数组的内容指纹（包含尺寸和通道数）
+        """
+        digest = hashlib.blake2b(repr(rgba.shape).encode(), digest_size=16)
+        digest.update(np.ascontiguousarray(rgba).data)
+        return digest.hexdigest()
+    
+    def load(self, image_path_or_pil) -> np.ndarray:
+        """
+        加载水印图片并转换为 RGBA 数组，内容相同的 logo 返回同一份只读数组
+
+        以路径传入时按 (路径, 修改时间, 大小) 记住指纹，命中时不再解码文件。
+        """
+        path_key = None
+        if isinstance(image_path_or_pil, str):
+            stat = os.stat(image_path_or_pil)
+            path_key = (os.path.abspath(image_path_or_pil), stat.st_mtime_ns, stat.st_size)
+            with self._lock:
+                digest = self._path_digests.get(path_key)
+                if digest is not None:
+                    self._path_digests.move_to_end(path_key)
+            if digest is not None:
+                cached = self.cache.get(("logo", digest))
+                if cached is not None:
+                    return cached
+        
+        rgba = self._decode(image_path_or_pil)
+        digest = self.fingerprint(rgba)
+        if path_key is not None:
+            with self._lock:
+                self._path_digests[path_key] = digest
+                self._path_digests.move_to_end(path_key)
+                while len(self._path_digests) > self.path_limit:
+                    self._path_digests.popitem(last=False)
+        cached = self.cache.get(("logo", digest))
+        if cached is not None:
+            return cached
+        
+        rgba.setflags(write=False)
+        self.cache.put(("logo", digest), rgba)
+        return rgba
+    
+    def get(self, digest: str) -> Optional[np.ndarray]:
+        """
+        按内容指纹取得已加载的水印数组，未加载或已被淘汰时返回 None
+        """
+        return self.cache.get(("logo", digest))
+    
+    def preload(self, paths) -> int:
+        """
+        预加载水印图片，返回成功加载的数量
+        """
+        loaded = 0
+        for path in paths:
+            try:
+                self.load(path)
+                loaded += 1
+            except Exception as e:
+                logger.warning("水印图片预加载失败 %s: %s", path, e)
+        if loaded:
+            logger.info("已预加载 %d 个水印图片", loaded)
+        return loaded
+    
+    def variant(self, rgba: np.ndarray, width: int, angle: float,
+                digest: Optional[str] = None) -> PreparedOverlay:
+        """
+        返回缩放到指定宽度并旋转后的预乘水印（未应用透明度），命中缓存时不再重复插值
+
+        digest 为已知的内容指纹（如 WatermarkSpec.logo），省去重新计算。
+        """
+        key = ("variant", digest or self.fingerprint(rgba), width, float(angle))
+        variant = self.cache.get(key)
+        if variant is None:
+            with metrics.time("logo_render"):
+                variant = self._render_variant(rgba, width, angle)
+            self.cache.put(key, variant)
+        return variant
+    
+    @staticmethod
+    def _decode(image_path_or_pil) -> np.ndarray:
+        # 保留 PNG/GIF 等格式的透明度
+        if isinstance(image_path_or_pil, str):
+            image = Image.open(image_path_or_pil)
+        elif isinstance(image_path_or_pil, np.ndarray):
+            array = image_path_or_pil
+            if array.ndim == 2:
+                array = np.repeat(array[..., None], 3, axis=2)
+            return np.array(array[..., :4], dtype=np.uint8)
+        else:
+            image = image_path_or_pil
+        
+        if image.mode == 'CMYK':
+            image = image.convert('RGB')
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        return np.array(image)
+    
+    @staticmethod
+    def _render_variant(watermark_image: np.ndarray, new_width: int, angle: float) -> PreparedOverlay:
+        """
+        将水印图片预乘透明通道后缩放、旋转
+
+        先预乘再插值，避免透明像素的颜色在缩放/旋转时渗入边缘；
+        旋转后露出的角落保持透明。
+        """
+        wm_h, wm_w = watermark_image.shape[:2]
+        new_width = max(1, new_width)
+        new_height = max(1, int(wm_h * new_width / wm_w))
+        
+        if watermark_image.shape[2] == 4:
+            premultiplied = PreparedOverlay.from_rgba(watermark_image)
+            rgba = np.concatenate([premultiplied.premultiplied, premultiplied.alpha], axis=2)
+        else:
+            opaque = np.full((wm_h, wm_w, 1), 255, dtype=np.uint8)
+            rgba = np.concatenate([watermark_image, opaque], axis=2)
+        
+        # 调整水印大小
+        stamp = cv2.resize(rgba, (new_width, new_height))
+        
+        # 如果需要旋转
+        if angle != 0:
+            center = (new_width // 2, new_height // 2)
+            rotation_matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+            stamp = cv2.warpAffine(stamp, rotation_matrix, (new_width, new_height),
+                                   borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+        
+        return PreparedOverlay(np.ascontiguousarray(stamp[..., :3]), np.ascontiguousarray(stamp[..., 3:4]))
+    
+    def stats(self) -> dict:
+        with self._lock:
+            paths = len(self._path_digests)
+        return dict(self.cache.stats(), paths=paths)
+
+
+class WatermarkProcessor:
+    def __init__(self, font_registry: Optional[FontRegistry] = None,
+                 overlay_cache: Optional[OverlayCache] = None,
+                 logo_registry: Optional[LogoRegistry] = None):
+        self.supported_formats = ['.jpg', '.jpeg', '.png', '.tiff', '.tif', '.bmp', '.webp', '.gif']
+        self.fonts = font_registry or FontRegistry()
+        self.logos = logo_registry or LogoRegistry()
+        self.overlay_cache = overlay_cache if overlay_cache is not None else OverlayCache()
     
     def convert_image_for_display(self, image):
         """
         将图像转换为适合在 Gradio 中显示的格式
         """
         if isinstance(image, Image.Image):
-            print(f"转换图像：原始模式={image.mode}, 格式={getattr(image, 'format', 'Unknown')}")
+            logger.debug("转换图像：原始模式=%s, 格式=%s", image.mode, getattr(image, 'format', 'Unknown'))
             
             # 处理各种图像模式
             if image.mode == 'CMYK':
                 # CMYK 转 RGB
-                image = image.convert('RGB')
-                print("CMYK -> RGB 转换完成")
+                image = convert_rgb(image)
+                logger.debug("CMYK -> RGB 转换完成")
             elif image.mode == 'L':
                 # 灰度转 RGB
-                image = image.convert('RGB')
-                print("灰度 -> RGB 转换完成")
+                image = convert_rgb(image)
+                logger.debug("灰度 -> RGB 转换完成")
             elif image.mode == 'P':
                 # 调色板模式转 RGB
                 if 'transparency' in image.info:
                     image = image.convert('RGBA').convert('RGB')
                 else:
                     image = image.convert('RGB')
-                print("调色板 -> RGB 转换完成")
+                logger.debug("调色板 -> RGB 转换完成")
             elif image.mode == '1':
                 # 1 位图像转 RGB
-                image = image.convert('RGB')
-                print("1 位图像 -> RGB 转换完成")
+                image = convert_rgb(image)
+                logger.debug("1 位图像 -> RGB 转换完成")
             elif image.mode == 'LA':
                 # 灰度 + 透明度转 RGB
                 image = image.convert('RGBA').convert('RGB')
-                print("LA -> RGB 转换完成")
+                logger.debug("LA -> RGB 转换完成")
             elif image.mode not in ['RGB', 'RGBA']:
                 # 其他模式统一转为 RGB
-                image = image.convert('RGB')
-                print(f"{image.mode} -> RGB 转换完成")
+                image = convert_rgb(image)
+                logger.debug("%s -> RGB 转换完成", image.mode)
             
-            print(f"最终模式：{image.mode}")
+            logger.debug("最终模式：%s", image.mode)
                 
         return image
     
-    def load_and_convert_image(self, image_path_or_pil):
+    def load_and_convert_image(self, image_path_or_pil, target_size: Optional[Tuple[int, int]] = None):
         """
         加载并转换图像，确保兼容性
+
+        指定 target_size（宽, 高）时按比例缩小到该范围内（不放大）：JPEG 在 DCT 域缩小解码，
+        只做完整解码的一小部分工作，其他格式完整解码后按面积重采样。
+        输出尺寸总是 fit_size(原图尺寸, target_size)，与缩小解码得到的中间尺寸无关。
         """
         try:
+            fitted = None
+            if target_size is not None:
+                probe = probe_image(image_path_or_pil)
+                fitted = fit_size((probe.width, probe.height), target_size)
             if isinstance(image_path_or_pil, str):
                 # 从路径加载图像
-                image = Image.open(image_path_or_pil)
+                with metrics.time("decode"):
+                    if target_size is not None:
+                        image = self.decode_reduced(image_path_or_pil, target_size)
+                    else:
+                        image = Image.open(image_path_or_pil)
+                        image.load()
             else:
-                # 已经是 PIL 图像
+                # 已经是 PIL 图像（尚未解码的 JPEG 仍可缩小解码）
                 image = image_path_or_pil
+                if target_size is not None:
+                    with metrics.time("decode"):
+                        image = self.decode_reduced(image, target_size)
             
             # 转换为显示格式
-            converted_image = self.convert_image_for_display(image)
+            with metrics.time("convert"):
+                converted_image = self.convert_image_for_display(image)
+                if fitted is not None and converted_image.size != fitted:
+                    converted_image = resize_image(converted_image, fitted)
             
-            print(f"图像信息：模式={image.mode}, 尺寸={image.size}, 格式={getattr(image, 'format', 'Unknown')}")
-            print(f"转换后：模式={converted_image.mode}, 尺寸={converted_image.size}")
+            logger.debug("图像信息：模式=%s, 尺寸=%s, 格式=%s", image.mode, image.size, getattr(image, 'format', 'Unknown'))
+            logger.debug("转换后：模式=%s, 尺寸=%s", converted_image.mode, converted_image.size)
             
             return converted_image
             
         except Exception as e:
-            print(f"图像加载/转换错误：{e}")
+            logger.error("图像加载/转换错误：%s", e)
             raise e
     
+    def decode_reduced(self, image_path_or_pil, target_size: Tuple[int, int]) -> Image.Image:
+        """
+        以不小于目标尺寸的最小代价解码图像
+
+        YCbCr/灰度 JPEG 文件路径使用 OpenCV 的 IMREAD_REDUCED_*（1/2、1/4、1/8 缩放），
+        CMYK（Adobe）JPEG 和尚未解码的 PIL JPEG 图像使用 Pillow 的 draft，其他格式完整解码。
+        返回的图像可能仍大于目标尺寸，由调用方按面积重采样到最终尺寸。
+        """
+        image = Image.open(image_path_or_pil) if isinstance(image_path_or_pil, str) else image_path_or_pil
+        fitted = fit_size(image.size, target_size)
+        if image.format in ('JPEG', 'MPO') and fitted != image.size:
+            factor = _reduced_decode_factor(image.size, fitted)
+            # OpenCV 对 CMYK JPEG 的颜色转换与 Pillow 完整解码后的转换不同，只用于 YCbCr/灰度
+            if isinstance(image_path_or_pil, str) and factor > 1 and image.mode in ('RGB', 'L'):
+                # 与 Pillow 一致，不按 EXIF 方向旋转
+                flags = _REDUCED_DECODE_FLAGS[factor] | cv2.IMREAD_IGNORE_ORIENTATION
+                bgr = cv2.imread(image_path_or_pil, flags)
+                if bgr is not None:
+                    image.close()
+                    logger.debug("JPEG 缩小解码：1/%d -> %dx%d", factor, bgr.shape[1], bgr.shape[0])
+                    return Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+            # 已解码的图像调用 draft 不会生效
+            image.draft('RGB', fitted)
+        image.load()
+        return image
+    
+    def load_watermark_image(self, image_path_or_pil) -> np.ndarray:
+        """
+        加载水印图片并转换为 RGBA 数组，保留 PNG/GIF 等格式的透明度
+
+        结果由 LogoRegistry 按内容去重缓存，返回的数组是只读的。
+        """
+        return self.logos.load(image_path_or_pil)
+    
     def add_text_watermark(self, 
                             image: np.ndarray, 
                             text: str, 
@@ -86,342 +935,2637 @@ class WatermarkProcessor:
                             spacing_x: int = 200,
                             spacing_y: int = 100) -> np.ndarray:
         """
-        添加文字水印
+        添加文字水印，image 为 RGB uint8 数组，原地修改并返回
+
+        等同于用这些参数构建 WatermarkSpec 并编译、应用渲染计划，
+        相同参数的后续请求直接混合缓存的覆盖层，不再渲染。
+        """
+        if not text.strip():
+            return image
+        
+        image_height, image_width = image.shape[:2]
+        spec = WatermarkSpec.from_params(
+            "text", text, font_size, color, None, position[0], position[1],
+            opacity, angle, 1.0, repeat_mode, spacing_x, spacing_y
+        )
+        return self.compile_plan(spec, (image_width, image_height)).apply(image)
+    
+    def compile_plan(self, spec: 'WatermarkSpec', canvas_size: Tuple[int, int],
+                     logo_rgba: Optional[np.ndarray] = None) -> 'WatermarkPlan':
+        """
+        将水印规格编译为指定画布尺寸的渲染计划，按 (规格, 画布尺寸, 字体) 缓存
+
+        重复文字水印渲染为整幅预乘覆盖层（混合最快）；单个文字水印和图片水印使用只含
+        水印边界框或一个周期单元的区域水印层，耗时和内存与水印大小成正比，与画布大小无关。
+        logo_rgba 为图片水印数组，省略时从 LogoRegistry 按指纹查找。
+        """
+        canvas_size = tuple(canvas_size)
+        cache_key = ('plan', spec, canvas_size, self.fonts.font_path)
+        plan = self.overlay_cache.get(cache_key)
+        if plan is None:
+            logger.debug("编译渲染计划：%s, 画布=%s", spec, canvas_size)
+            with metrics.time("overlay_render"):
+                if spec.kind == "text" and spec.repeat:
+                    # 计算透明度值 (确保有足够的可见度)
+                    alpha = max(50, int(255 * spec.opacity))  # 最小透明度为 50，确保可见
+                    overlay = self._render_text_overlay(
+                        canvas_size, spec.text, spec.font_size, spec.color, alpha, spec.angle, *spec.spacing
+                    )
+                    layer = PreparedOverlay.from_rgba(overlay)
+                else:
+                    layer = self.compile_layer(spec, canvas_size, logo_rgba)
+            plan = WatermarkPlan(spec, canvas_size, layer)
+            self.overlay_cache.put(cache_key, plan)
+        return plan
+    
+    def compile_layer(self, spec: 'WatermarkSpec', canvas_size: Tuple[int, int],
+                      logo_rgba: Optional[np.ndarray] = None):
+        """
+        将水印规格编译为可按区域混合的水印层（不分配整幅画布），用于流式处理和预览
+        """
+        position = spec.position_for(canvas_size)
+        if spec.kind == "text":
+            return self.prepare_text_layer(
+                canvas_size, spec.text, position, spec.font_size, spec.color,
+                spec.opacity, spec.angle, spec.repeat, *spec.spacing
+            )
+        
+        if logo_rgba is None:
+            logo_rgba = self.logos.get(spec.logo)
+            if logo_rgba is None:
+                raise ValueError("水印图片已失效，请重新上传")
+        return self.prepare_image_layer(
+            canvas_size, logo_rgba, position, spec.scale, spec.opacity, spec.angle,
+            spec.repeat, *spec.spacing, logo_digest=spec.logo
+        )
+    
+    def prepare_text_layer(self, canvas_size, text, position, font_size, color,
+                           opacity, angle, repeat_mode, spacing_x, spacing_y):
+        """
+        准备可按区域混合的文字水印层（不分配整幅画布），用于流式等分块处理
+
+        重复模式返回 TiledOverlay，单个水印返回 PlacedOverlay。
+        """
+        alpha = max(50, int(255 * opacity))
+        font, bbox = self._text_metrics(text, font_size)
+        
+        if repeat_mode:
+            spacing = self._effective_spacing(bbox, spacing_x, spacing_y)
+            stamp, stamp_offset = self._render_text_stamp(text, font, color, alpha, angle, bbox)
+            cell = self._render_tile_cell(stamp, stamp_offset, spacing, use_mask=(angle != 0))
+            return TiledOverlay(PreparedOverlay.from_rgba(cell))
+        
+        stamp, (paste_x, paste_y) = self._render_single_text_stamp(
+            canvas_size, text, position, font, color, alpha, angle, bbox
+        )
+        # 裁掉旋转留下的透明边，覆盖层只保留文字实际覆盖的矩形
+        box = stamp.getchannel('A').getbbox() or (0, 0, 1, 1)
+        stamp = np.asarray(stamp)[box[1]:box[3], box[0]:box[2]]
+        return PlacedOverlay(PreparedOverlay.from_rgba(stamp), paste_x + box[0], paste_y + box[1])
+    
+    def _text_metrics(self, text, font_size):
+        """
+        返回 (字体, 文字边界框)
+        """
+        # 从字体注册表获取字体（路径已在启动时解析，字体对象按字号缓存）
+        font = self.fonts.get_font(font_size)
+        bbox = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), text, font=font)
+        return font, bbox
+    
+    def _effective_spacing(self, bbox, spacing_x, spacing_y):
+        # 确保间距合理
+        text_width = bbox[2] - bbox[0]
+        text_height = bbox[3] - bbox[1]
+        return max(spacing_x, text_width + 20), max(spacing_y, text_height + 20)
+    
+    def _render_text_overlay(self, canvas_size, text, font_size, color,
+                             alpha, angle, spacing_x, spacing_y) -> np.ndarray:
+        """
+        渲染与画布同尺寸的重复文字覆盖层，返回 RGBA 数组
+        """
+        image_width, image_height = canvas_size
+        font, bbox = self._text_metrics(text, font_size)
+        effective_spacing_x, effective_spacing_y = self._effective_spacing(bbox, spacing_x, spacing_y)
+        
+        logger.debug("重复水印：图像尺寸=%dx%d, 间距=%dx%d", image_width, image_height, effective_spacing_x, effective_spacing_y)
+        
+        # 水印印章只渲染一次，再按错位网格平铺到整个画布
+        stamp, stamp_offset = self._render_text_stamp(text, font, color, alpha, angle, bbox)
+        return self._tile_stamp(
+            stamp, stamp_offset, canvas_size,
+            (effective_spacing_x, effective_spacing_y),
+            use_mask=(angle != 0)
+        )
+    
+    def _render_single_text_stamp(self, canvas_size, text, position, font, color, alpha, angle, bbox):
+        """
+        渲染单个水印模式的文字印章，返回 (RGBA 印章, 画布上的粘贴位置)
+        """
+        image_width, image_height = canvas_size
+        
+        if angle != 0:
+            text_width = bbox[2] - bbox[0]
+            text_height = bbox[3] - bbox[1]
+            
+            # 创建临时图像用于旋转
+            temp_size = max(text_width, text_height) + 100
+            temp_img = Image.new('RGBA', (temp_size, temp_size), (0, 0, 0, 0))
+            temp_draw = ImageDraw.Draw(temp_img)
+            temp_draw.text((50, 50), text, font=font, fill=(*color, alpha))
+            
+            # 旋转
+            rotated = temp_img.rotate(angle, expand=True)
+            
+            # 计算粘贴位置
+            paste_x = max(0, min(position[0], image_width - rotated.width))
+            paste_y = max(0, min(position[1], image_height - rotated.height))
+            
+            # 与以自身为蒙版粘贴到透明图层上的效果保持一致
+            stamp = Image.new('RGBA', rotated.size, (0, 0, 0, 0))
+            stamp.paste(rotated, (0, 0), rotated)
+            return stamp, (paste_x, paste_y)
+        
+        # 不旋转时等同于直接在 position 处绘制文字
+        stamp, (offset_x, offset_y) = self._render_text_stamp(text, font, color, alpha, 0, bbox)
+        return stamp, (position[0] + offset_x, position[1] + offset_y)
+    
+    def _render_text_stamp(self, text, font, color, alpha, angle, bbox):
+        """
+        渲染单个文字印章，返回 (RGBA 印章, 相对网格点的偏移)
+        """
+        text_width = bbox[2] - bbox[0]
+        text_height = bbox[3] - bbox[1]
+        
+        if angle != 0:
+            # 为旋转文字创建临时图像，旋转后以网格点为中心
+            temp_size = max(text_width, text_height) + 100
+            temp_img = Image.new('RGBA', (temp_size, temp_size), (0, 0, 0, 0))
+            temp_draw = ImageDraw.Draw(temp_img)
+            temp_draw.text((temp_size//2 - text_width//2, temp_size//2 - text_height//2), 
+                           text, font=font, fill=(*color, alpha))
+            rotated = temp_img.rotate(angle, expand=True)
+            return rotated, (-(rotated.width // 2), -(rotated.height // 2))
+        
+        # 不旋转时文字左上角对齐网格点，与直接在网格点绘制文字一致
+        offset_x = min(0, bbox[0])
+        offset_y = min(0, bbox[1])
+        stamp = Image.new('RGBA', (max(1, bbox[2] - offset_x), max(1, bbox[3] - offset_y)), (0, 0, 0, 0))
+        ImageDraw.Draw(stamp).text((-offset_x, -offset_y), text, font=font, fill=(*color, alpha))
+        return stamp, (offset_x, offset_y)
+    
+    def _tile_stamp(self, stamp, stamp_offset, canvas_size, spacing, use_mask=True) -> np.ndarray:
+        """
+        将印章按错位网格平铺，返回与画布同尺寸的 RGBA 数组
+
+        网格点为 (col * spacing_x, row * spacing_y)，奇数行水平错开半个间距，
+        因此图案以 (spacing_x, 2 * spacing_y) 为周期。这里只渲染一个周期单元
+        （处理跨边界的环绕），再用 np.tile 铺满画布，耗时与像素数成正比，
+        与网格数量无关。
+        """
+        image_width, image_height = canvas_size
+        cell = self._render_tile_cell(stamp, stamp_offset, spacing, use_mask)
+        return tile_array(cell, 0, 0, image_width, image_height)
+    
+    def _render_tile_cell(self, stamp, stamp_offset, spacing, use_mask=True) -> np.ndarray:
+        """
+        渲染错位网格的一个周期单元 (spacing_y * 2) × spacing_x，返回 RGBA 数组
+        """
+        spacing_x, spacing_y = spacing
+        period_w, period_h = spacing_x, spacing_y * 2
+        
+        cell = Image.new('RGBA', (period_w, period_h), (0, 0, 0, 0))
+        mask = stamp if use_mask else None
+        positions = []
+        for lattice_x, lattice_y in ((0, 0), (spacing_x // 2, spacing_y)):
+            start_x = (lattice_x + stamp_offset[0]) % period_w
+            start_y = (lattice_y + stamp_offset[1]) % period_h
+            for paste_y in range(start_y, -stamp.height, -period_h):
+                for paste_x in range(start_x, -stamp.width, -period_w):
+                    positions.append((paste_y, paste_x))
+        
+        # 与逐个绘制时的顺序一致（按行、再按列），重叠处后绘制的水印在上层
+        for paste_y, paste_x in sorted(positions):
+            cell.paste(stamp, (paste_x, paste_y), mask)
+        
+        return np.asarray(cell)
+    
+    def add_image_watermark(self, 
+                           image: np.ndarray, 
+                           watermark_image: np.ndarray, 
+                           position: Tuple[int, int], 
+                           scale: float = 0.2, 
+                           opacity: float = 0.7, 
+                           angle: float = 0,
+                           repeat_mode: bool = False,
+                           spacing_x: int = 200,
+                           spacing_y: int = 100) -> np.ndarray:
+        """
+        添加图片水印，image 为 RGB uint8 数组，原地修改并返回
+
+        watermark_image 可以是 RGB 或 RGBA 数组，RGBA 时按透明通道混合。
+        单个水印只读写水印覆盖的区域，耗时与水印大小成正比，与原图大小无关；
+        重复模式的耗时相当于一次整幅混合，与网格数量无关。
+        """
+        h, w = image.shape[:2]
+        spec = WatermarkSpec.from_params(
+            "image", "", 0, None, watermark_image, position[0], position[1],
+            opacity, angle, scale, repeat_mode, spacing_x, spacing_y
+        )
+        # 原地混合，超出图像边界的部分被裁剪
+        return self.compile_plan(spec, (w, h), watermark_image).apply(image)
+    
+    def prepare_image_layer(self, canvas_size, watermark_image: np.ndarray, position: Tuple[int, int],
+                            scale: float = 0.2, opacity: float = 0.7, angle: float = 0,
+                            repeat_mode: bool = False, spacing_x: int = 200, spacing_y: int = 100,
+                            logo_digest: Optional[str] = None):
+        """
+        准备可按区域混合的图片水印层
+
+        水印只缩放、旋转一次：重复模式按与文字水印相同的错位网格排成一个周期单元，
+        返回 TiledOverlay；单个水印返回放置好的 PlacedOverlay。
+        """
+        w, h = canvas_size
+        
+        # 预乘后的水印（已缩放、旋转并应用透明度）
+        stamp = self._prepare_image_stamp(watermark_image, int(w * scale), opacity, angle, logo_digest)
+        new_height, new_width = stamp.alpha.shape[:2]
+        
+        if repeat_mode:
+            # 与文字水印相同，间距至少比水印大 20 像素
+            spacing = (max(spacing_x, new_width + 20), max(spacing_y, new_height + 20))
+            return TiledOverlay(self._render_image_tile_cell(stamp, spacing))
+        
+        # 确保位置在图像范围内
+        y1 = max(0, min(position[1], h - new_height))
+        x1 = max(0, min(position[0], w - new_width))
+        return PlacedOverlay(stamp, x1, y1)
+    
+    def _render_image_tile_cell(self, stamp: PreparedOverlay, spacing) -> PreparedOverlay:
+        """
+        将预乘水印放入错位网格的一个周期单元 (spacing_y * 2) × spacing_x
+
+        网格与 _render_tile_cell 相同，水印左上角对齐网格点，越过单元边界的部分环绕到另一侧。
+        间距不小于水印尺寸，两组网格点上的水印互不重叠，因此可以直接按环绕索引整块写入。
+        """
+        spacing_x, spacing_y = spacing
+        period_w, period_h = spacing_x, spacing_y * 2
+        stamp_h, stamp_w = stamp.alpha.shape[:2]
+        
+        premultiplied = np.zeros((period_h, period_w, 3), dtype=np.uint8)
+        alpha = np.zeros((period_h, period_w, 1), dtype=np.uint8)
+        for lattice_x, lattice_y in ((0, 0), (spacing_x // 2, spacing_y)):
+            index = np.ix_((lattice_y + np.arange(stamp_h)) % period_h,
+                           (lattice_x + np.arange(stamp_w)) % period_w)
+            premultiplied[index] = stamp.premultiplied
+            alpha[index] = stamp.alpha
+        return PreparedOverlay(premultiplied, alpha)
+    
+    def _prepare_image_stamp(self, watermark_image: np.ndarray, new_width: int,
+                             opacity: float, angle: float, digest: Optional[str] = None) -> PreparedOverlay:
+        """
+        取得缩放、旋转后的预乘水印（由 LogoRegistry 按宽度和角度缓存），再乘以整体透明度
+        """
+        variant = self.logos.variant(watermark_image, max(1, new_width), angle, digest)
+        if opacity >= 1.0:
+            return variant
+        
+        # 应用透明度（预乘颜色与 alpha 同比例缩放）
+        def fade(channels):
+            return (channels.astype(np.float32) * opacity + 0.5).astype(np.uint8)
+        return PreparedOverlay(fade(variant.premultiplied), fade(variant.alpha))
+
+_REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def fit_size(size: Tuple[int, int], target_size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    返回在 target_size 范围内保持宽高比的最大尺寸，不放大
+    """
+    width, height = size
+    factor = min(1.0, target_size[0] / width, target_size[1] / height)
+    return max(1, round(width * factor)), max(1, round(height * factor))
+
+
+def _reduced_decode_factor(size: Tuple[int, int], fitted: Tuple[int, int]) -> int:
+    # 解码结果（向上取整）仍不小于目标尺寸的最大缩放倍数
+    for factor in (8, 4, 2):
+        if -(-size[0] // factor) >= fitted[0] and -(-size[1] // factor) >= fitted[1]:
+            return factor
+    return 1
+
+
+def resize_image(image: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """
+    按面积重采样到指定尺寸（宽, 高）
+    """
+    resized = cv2.resize(np.asarray(image), size, interpolation=cv2.INTER_AREA)
+    return Image.fromarray(resized, image.mode)
+
+
+def resize_to_fit(image: Image.Image, target_size: Tuple[int, int]) -> Image.Image:
+    """
+    按面积重采样缩小到 target_size 范围内，已经足够小时原样返回
+    """
+    fitted = fit_size(image.size, target_size)
+    if fitted == image.size:
+        return image
+    return resize_image(image, fitted)
+
+# 可以按条带分别转换的 PIL 模式（逐像素转换，结果与整幅转换一致）
+_STRIP_CONVERT_MODES = {'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr', 'L', 'LA', '1', 'P'}
+
+
+def _use_strips(image: Image.Image) -> bool:
+    return (image.mode in _STRIP_CONVERT_MODES and image.width * image.height >= PARALLEL_MIN_PIXELS
+            and composite_threads() > 1)
+
+
+def rgb_strips(image: Image.Image, threads: Optional[int] = None) -> np.ndarray:
+    """
+    按水平条带并行地将 PIL 图像转换为新的 RGB uint8 数组
+    """
+    # 先在当前线程完成解码，避免各线程在 crop 时重复触发加载
+    image.load()
+    width, height = image.size
+    rgb = np.empty((height, width, 3), dtype=np.uint8)
+    
+    def work(top, bottom):
+        strip = image.crop((0, top, width, bottom))
+        rgb[top:bottom] = np.asarray(strip if strip.mode == 'RGB' else strip.convert('RGB'))
+    
+    run_strips(height, width, work, threads)
+    return rgb
+
+
+def convert_rgb(image: Image.Image) -> Image.Image:
+    """
+    将 PIL 图像转换为 RGB 模式，大图按条带并行转换
+    """
+    if _use_strips(image):
+        return Image.fromarray(rgb_strips(image))
+    return image.convert('RGB')
+
+
+def to_rgb_array(image, copy: bool = True) -> np.ndarray:
+    """
+    将 PIL 图像或数组转换为 RGB uint8 数组
+
+    copy=True 时保证返回可写的独立缓冲区，供水印原地混合使用；大图按条带并行转换和复制。
+    """
+    if isinstance(image, Image.Image):
+        if copy and _use_strips(image):
+            return rgb_strips(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return np.array(image) if copy else np.asarray(image)
+    
+    array = np.asarray(image, dtype=np.uint8)
+    if array.ndim == 2:
+        array = np.repeat(array[..., None], 3, axis=2)
+    elif array.shape[2] == 4:
+        array = array[..., :3]
+    return np.array(array) if copy else np.ascontiguousarray(array)
+
+# 全局处理器实例
+processor = WatermarkProcessor()
+
+
+def init_worker(log_level: str = "WARNING") -> None:
+    """
+    工作进程初始化：配置日志，预加载环境变量 WATERMARK_PRELOAD_LOGOS
+    （多个路径用 os.pathsep 分隔）中的水印图片，并预热处理流程
+    """
+    configure_logging(log_level)
+    paths = [path for path in os.environ.get("WATERMARK_PRELOAD_LOGOS", "").split(os.pathsep) if path]
+    processor.logos.preload(paths)
+    warm_up()
+
+
+def warm_up() -> float:
+    """
+    预热处理流程，返回耗时（秒）
+
+    加载默认字号的字体，初始化 OpenCV 的线程池和 JPEG/PNG 编解码器，并在小画布上
+    编译、应用一次文字和图片水印，使第一个请求不再承担这些一次性开销。
+    预热的耗时不计入阶段统计；环境变量 WATERMARK_WARMUP=0 时跳过。
+    """
+    if os.environ.get("WATERMARK_WARMUP", "1") == "0":
+        return 0.0
+    start = time.perf_counter()
+    with metrics.paused():
+        canvas = np.full((512, 512, 3), 128, dtype=np.uint8)
+        # 足够大的 resize 会触发 OpenCV 创建并行线程池
+        cv2.resize(canvas, (384, 384), interpolation=cv2.INTER_AREA)
+        logo = np.zeros((64, 128, 4), dtype=np.uint8)
+        logo[16:48, 16:112] = 255
+        for repeat in (True, False):
+            for kind, rgba in (("text", None), ("image", logo)):
+                spec = WatermarkSpec.from_params(kind, "WATERMARK", 40, "#FF4757", rgba, 100, 100,
+                                                 0.4, -30, 0.2, repeat, 150, 100)
+                processor.compile_plan(spec, (512, 512), rgba).apply(canvas)
+        for output_format in ("jpeg", "png"):
+            encoded = encode_image(canvas, output_format)
+        cv2.imdecode(np.frombuffer(encoded, dtype=np.uint8), cv2.IMREAD_COLOR)
+    elapsed = time.perf_counter() - start
+    logger.info("预热完成，用时 %.0f ms", elapsed * 1000)
+    return elapsed
+
+
+def notify_ready(status: Optional[str] = None) -> None:
+    """
+    以 systemd Type=notify 服务运行时报告就绪（向 NOTIFY_SOCKET 发送 READY=1），其他情况下不做任何事
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    import socket
+    
+    if address.startswith("@"):
+        # 抽象命名空间套接字
+        address = "\0" + address[1:]
+    message = "READY=1" + (f"\nSTATUS={status}" if status else "")
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(message.encode())
+    except OSError as e:
+        logger.warning("无法通知 systemd：%s", e)
+
+def parse_color(text_color) -> Tuple[int, int, int]:
+    """
+    解析颜色值，支持 #RRGGBB、#RGB、rgb(r,g,b) 和 RGB 元组，无法解析时返回灰色
+    """
+    try:
+        if isinstance(text_color, str) and text_color.startswith('#'):
+            # 处理 #FFFFFF 格式
+            hex_color = text_color.lstrip('#')
+            if len(hex_color) == 6:
+                color_rgb = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+            elif len(hex_color) == 3:
+                # 处理 #FFF 格式
+                color_rgb = tuple(int(hex_color[i]*2, 16) for i in range(3))
+            else:
+                raise ValueError("Invalid hex color format")
+        elif isinstance(text_color, str) and text_color.startswith('rgb'):
+            # 处理 rgb(255,255,255) 格式
+            rgb_values = re.findall(r'\d+', text_color)
+            if len(rgb_values) >= 3:
+                color_rgb = tuple(int(rgb_values[i]) for i in range(3))
+            else:
+                raise ValueError("Invalid rgb color format")
+        elif isinstance(text_color, (list, tuple)) and len(text_color) >= 3:
+            # 处理已经是 RGB 元组的情况
+            color_rgb = tuple(int(c) for c in text_color[:3])
+        else:
+            # 尝试直接解析为 hex（去掉#）
+            if isinstance(text_color, str):
+                clean_color = text_color.lstrip('#')
+                if len(clean_color) == 6:
+                    color_rgb = tuple(int(clean_color[i:i+2], 16) for i in (0, 2, 4))
+                else:
+                    raise ValueError("Unknown color format")
+            else:
+                raise ValueError("Unknown color format")
+        
+        # 确保颜色值在有效范围内
+        return tuple(max(0, min(255, int(c))) for c in color_rgb)
+    
+    except (ValueError, IndexError, TypeError) as e:
+        logger.warning("颜色解析错误：%s, 原始值：%s, 使用默认灰色", e, text_color)
+        return (128, 128, 128)  # 使用灰色作为默认
+
+
+# 水印类型：规格与命令行使用的名称 -> 界面标签
+WATERMARK_TYPES = {"text": "文字水印", "image": "图片水印"}
+_WATERMARK_KINDS = {label: kind for kind, label in WATERMARK_TYPES.items()}
+
+
+class WatermarkSpec(NamedTuple):
+    """
+    校验、规范化后的水印参数：不可变、可哈希，可直接作为缓存键，并能廉价地传给工作进程
+
+    kind 为 "text" 或 "image"。图片水印以内容指纹 logo 引用 LogoRegistry 中的数组，
+    数组本身不进入规格。与当前类型/模式无关的字段被置为固定值（如重复模式下的位置），
+    使等价的参数得到相同的规格。位置的上限取决于画布尺寸，编译时由 position_for 确定。
+    """
+    kind: str
+    text: str = ""
+    font_size: int = 0
+    color: Tuple[int, int, int] = (0, 0, 0)
+    logo: Optional[str] = None
+    position: Tuple[int, int] = (0, 0)
+    opacity: float = 1.0
+    angle: float = 0.0
+    scale: float = 1.0
+    repeat: bool = False
+    spacing: Tuple[int, int] = (0, 0)
+    
+    @classmethod
+    def from_params(cls, watermark_type, text_content, text_font_size, text_color, watermark_rgba,
+                    position_x, position_y, opacity, angle, scale,
+                    repeat_mode, spacing_x, spacing_y) -> 'WatermarkSpec':
+        """
+        由界面/命令行参数构建规格，解析颜色并将参数限制在合理范围内，参数无效时抛出 ValueError
+
+        watermark_type 可以是 "text"/"image" 或界面标签"文字水印"/"图片水印"。
+        """
+        kind = watermark_type if watermark_type in WATERMARK_TYPES else _WATERMARK_KINDS.get(watermark_type)
+        if kind is None:
+            raise ValueError("请选择水印类型")
+        
+        repeat_mode = bool(repeat_mode)
+        fields = {
+            "kind": kind,
+            "repeat": repeat_mode,
+            # 限制透明度在有效范围内
+            "opacity": max(0.0, min(float(opacity), 1.0)),
+            # 限制角度在有效范围内
+            "angle": max(-180.0, min(float(angle), 180.0)),
+        }
+        if repeat_mode:
+            # 限制间距参数；重复模式不使用位置
+            fields["spacing"] = (max(50, min(int(spacing_x), 500)), max(50, min(int(spacing_y), 300)))
+        else:
+            fields["position"] = (max(0, int(position_x)), max(0, int(position_y)))
+        
+        if kind == "text":
+            if not text_content or not text_content.strip():
+                raise ValueError("请输入水印文字")
+            fields["text"] = text_content
+            # 限制字体大小在合理范围内
+            fields["font_size"] = max(1, min(int(text_font_size), 500))
+            fields["color"] = parse_color(text_color)
+        else:
+            if watermark_rgba is None:
+                raise ValueError("请上传水印图片")
+            fields["logo"] = LogoRegistry.fingerprint(watermark_rgba)
+            # 限制缩放比例在有效范围内
+            fields["scale"] = max(0.01, min(float(scale), 2.0))
+        return cls(**fields)
+    
+    def position_for(self, canvas_size: Tuple[int, int]) -> Tuple[int, int]:
+        """
+        返回限制在画布范围内的位置
+        """
+        width, height = canvas_size
+        return min(self.position[0], width - 1), min(self.position[1], height - 1)
+
+
+class WatermarkPlan:
+    """
+    编译好的渲染计划：字体、颜色、透明度、缩放旋转后的印章和网格偏移都已烘焙进水印层，
+    apply() 只做混合，同尺寸的一批图片可以重复使用同一个计划
+    """
+    __slots__ = ('spec', 'canvas_size', 'layer')
+    
+    def __init__(self, spec: WatermarkSpec, canvas_size: Tuple[int, int], layer):
+        self.spec = spec
+        self.canvas_size = tuple(canvas_size)
+        self.layer = layer
+    
+    @property
+    def nbytes(self) -> int:
+        return self.layer.nbytes
+    
+    def apply(self, rgb_image: np.ndarray) -> np.ndarray:
+        """
+        在 RGB uint8 数组上原地添加水印并返回，图像尺寸必须与计划一致
+        """
+        height, width = rgb_image.shape[:2]
+        if (width, height) != self.canvas_size:
+            raise ValueError(f"图像尺寸 {width}x{height} 与渲染计划 {self.canvas_size[0]}x{self.canvas_size[1]} 不一致")
+        with metrics.time("composite"):
+            return blend_layer(self.layer, rgb_image)
+
+
+def apply_watermark(rgb_image: np.ndarray, watermark_type, text_content, text_font_size, text_color,
+                    watermark_rgba, position_x, position_y, opacity, angle, scale,
+                    repeat_mode, spacing_x, spacing_y) -> np.ndarray:
+    """
+    校验参数后在 RGB 数组上原地添加水印，参数无效时抛出 ValueError
+
+    等同于 WatermarkSpec.from_params + compile_plan + apply；处理一批图片时
+    直接复用规格和计划可省去每张图片的参数解析。watermark_rgba 为已加载的 RGBA 水印数组。
+    """
+    spec = WatermarkSpec.from_params(
+        watermark_type, text_content, text_font_size, text_color, watermark_rgba,
+        position_x, position_y, opacity, angle, scale, repeat_mode, spacing_x, spacing_y
+    )
+    height, width = rgb_image.shape[:2]
+    return processor.compile_plan(spec, (width, height), watermark_rgba).apply(rgb_image)
+
+
+def build_watermark_layer(canvas_size, watermark_type, text_content, text_font_size, text_color,
+                          watermark_rgba, position_x, position_y, opacity, angle, scale,
+                          repeat_mode, spacing_x, spacing_y):
+    """
+    与 apply_watermark 参数相同，但返回可按区域混合的水印层，供分块/流式处理使用
+    """
+    spec = WatermarkSpec.from_params(
+        watermark_type, text_content, text_font_size, text_color, watermark_rgba,
+        position_x, position_y, opacity, angle, scale, repeat_mode, spacing_x, spacing_y
+    )
+    return processor.compile_layer(spec, canvas_size, watermark_rgba)
+
+
+def process_watermark(image, watermark_type, text_content, text_font_size, text_color, 
+                     watermark_image, position_x, position_y, opacity, angle, scale, 
+                     repeat_mode, spacing_x, spacing_y, target_size=None):
+    """
+    处理水印添加的主函数
+
+    target_size（宽, 高）由准入控制给出，超大图片在解码时按比例缩小到该范围内。
+    """
+    if image is None:
+        return None, "请先上传图片"
+    
+    try:
+        # 首先转换图像格式以确保兼容性
+        converted_image = processor.load_and_convert_image(image, target_size)
+        
+        # 转换为 RGB uint8 数组，整个处理流程只使用这一份可写缓冲区
+        with metrics.time("convert"):
+            rgb_image = to_rgb_array(converted_image)
+        
+        # 转换水印图片为 RGBA 数组，保留透明通道
+        watermark_rgba = None
+        if watermark_type == "图片水印" and watermark_image is not None:
+            watermark_rgba = processor.load_watermark_image(watermark_image)
+        
+        try:
+            result = apply_watermark(
+                rgb_image, watermark_type, text_content, text_font_size, text_color,
+                watermark_rgba, position_x, position_y, opacity, angle, scale,
+                repeat_mode, spacing_x, spacing_y
+            )
+        except ValueError as e:
+            return converted_image, str(e)
+        
+        # 转换回 PIL 格式用于显示（结果已是 RGB，无需颜色转换）
+        with metrics.time("convert"):
+            result_pil = Image.fromarray(result)
+        return result_pil, "水印添加成功！"
+        
+    except Exception as e:
+        # 如果处理失败，返回转换后的原图
+        try:
+            converted_image = processor.load_and_convert_image(image, target_size)
+            return converted_image, f"处理失败：{str(e)}"
+        except:
+            return image, f"处理失败：{str(e)}"
+
+
+# 预览图的最长边（像素），滑块调整时只在该尺寸的代理图上渲染
+PREVIEW_MAX_SIDE = 1024
+
+
+def make_preview_proxy(image, max_side: int = PREVIEW_MAX_SIDE):
+    """
+    生成缩小的预览代理图，返回 (RGB 数组, 原图尺寸)
+    """
+    if image is None:
+        return None
+    
+    # 原图尺寸只读取文件头，像素按预览尺寸缩小解码
+    if isinstance(image, str):
+        with Image.open(image) as header:
+            width, height = header.size
+    else:
+        width, height = image.size
+    converted_image = processor.load_and_convert_image(image, (max_side, max_side))
+    return to_rgb_array(converted_image), (width, height)
+
+
+def process_preview(preview_state, watermark_type, text_content, text_font_size, text_color,
+                    watermark_image, position_x, position_y, opacity, angle, scale,
+                    repeat_mode, spacing_x, spacing_y):
+    """
+    在预览代理图上渲染水印
+
+    水印层按原图尺寸构建（位置、字号、间距与最终结果一致），再整体缩放到代理图，
+    因此预览与原尺寸结果的几何关系相同。
+    """
+    if preview_state is None:
+        return None, "请先上传图片"
+    
+    proxy, canvas_size = preview_state
+    try:
+        watermark_rgba = None
+        if watermark_type == "图片水印" and watermark_image is not None:
+            watermark_rgba = processor.load_watermark_image(watermark_image)
+        layer = build_watermark_layer(
+            canvas_size, watermark_type, text_content, text_font_size, text_color,
+            watermark_rgba, position_x, position_y, opacity, angle, scale,
+            repeat_mode, spacing_x, spacing_y
+        )
+    except ValueError as e:
+        return Image.fromarray(proxy), str(e)
+    except Exception as e:
+        return Image.fromarray(proxy), f"预览失败：{str(e)}"
+    
+    preview = proxy.copy()
+    proxy_h, proxy_w = preview.shape[:2]
+    layer.scaled(proxy_w / canvas_size[0], proxy_h / canvas_size[1]).blend_region(preview)
+    return Image.fromarray(preview), f"预览（{proxy_w}x{proxy_h}），点击\"添加水印\"生成原尺寸结果"
+
+
+# ---------------------------------------------------------------------------
+# 输出编码（直接从 RGB 缓冲区编码，格式与质量可配置）
+# ---------------------------------------------------------------------------
+
+# 输出格式 -> 文件扩展名
+OUTPUT_FORMATS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp", "tiff": ".tif", "bmp": ".bmp"}
+# Pillow 识别的输入格式 -> 输出格式，不在表中的格式（如 GIF）输出 PNG
+_SOURCE_FORMATS = {"JPEG": "jpeg", "MPO": "jpeg", "PNG": "png", "WEBP": "webp", "TIFF": "tiff", "BMP": "bmp"}
+_EXTENSION_FORMATS = {
+    ".jpg": "jpeg", ".jpeg": "jpeg", ".png": "png", ".webp": "webp",
+    ".tif": "tiff", ".tiff": "tiff", ".bmp": "bmp",
+}
+
+# JPEG/WebP 质量（1-100）与 PNG 压缩级别（0-9，越小越快）
+DEFAULT_QUALITY = env_number("WATERMARK_QUALITY", 90, minimum=1, maximum=100)
+DEFAULT_PNG_COMPRESSION = env_number("WATERMARK_PNG_COMPRESSION", 1, minimum=0, maximum=9)
+
+
+def resolve_output_format(requested: Optional[str] = None, source_format: Optional[str] = None,
+                          path: Optional[str] = None) -> str:
+    """
+    确定输出格式
+
+    requested 为空或 "auto" 时与输入保持一致（依次参考 Pillow 的 format 和文件扩展名），
+    JPEG 输入输出 JPEG，无法确定时使用 PNG。
+    """
+    if requested and requested.lower() != "auto":
+        output_format = requested.lower()
+        output_format = "jpeg" if output_format == "jpg" else output_format
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"不支持的输出格式：{requested}")
+        return output_format
+    if source_format:
+        return _SOURCE_FORMATS.get(source_format.upper(), "png")
+    if path:
+        return _EXTENSION_FORMATS.get(os.path.splitext(path)[1].lower(), "png")
+    return "png"
+
+
+def encode_image(image, output_format: str = "png", quality: int = DEFAULT_QUALITY,
+                 png_compression: int = DEFAULT_PNG_COMPRESSION) -> bytes:
+    """
+    将 RGB 数组（或 PIL 图像）编码为指定格式
+
+    优先使用 cv2.imencode 直接编码 NumPy 缓冲区，OpenCV 不支持该格式
+    （如编译时未包含 WebP）时回退到 Pillow。
+    """
+    rgb = to_rgb_array(image, copy=False)
+    with metrics.time("encode"):
+        params = {
+            "jpeg": [cv2.IMWRITE_JPEG_QUALITY, int(quality)],
+            "webp": [cv2.IMWRITE_WEBP_QUALITY, int(quality)],
+            "png": [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)],
+        }.get(output_format, [])
+        try:
+            ok, buffer = cv2.imencode(OUTPUT_FORMATS[output_format], cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), params)
+        except cv2.error:
+            ok = False
+        if ok:
+            return buffer.tobytes()
+
+        logger.debug("OpenCV 无法编码 %s，改用 Pillow", output_format)
+        save_options = {
+            "jpeg": {"quality": int(quality)},
+            "webp": {"quality": int(quality)},
+            "png": {"compress_level": int(png_compression)},
+        }.get(output_format, {})
+        output = io.BytesIO()
+        Image.fromarray(rgb).save(output, format=output_format.upper(), **save_options)
+        return output.getvalue()
+
+
+def save_image(image, path: str, output_format: Optional[str] = None, quality: int = DEFAULT_QUALITY,
+               png_compression: int = DEFAULT_PNG_COMPRESSION) -> str:
+    """
+    编码并写入文件，未指定格式时按扩展名确定，返回文件路径
+    """
+    data = encode_image(image, output_format or resolve_output_format(path=path), quality, png_compression)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+# ---------------------------------------------------------------------------
+# 结果缓存（按内容寻址的磁盘缓存，多进程共享）
+# ---------------------------------------------------------------------------
+
+# 渲染或编码方式变化导致旧结果失效时递增
+RESULT_CACHE_VERSION = 1
+
+
+class ResultCache:
+    """
+    按内容寻址的水印结果磁盘缓存
+
+    键由输入内容的哈希、规范化后的水印规格（WatermarkSpec，logo 以内容指纹表示）、字体
+    和输出编码参数组成，值为编码后的文件。写入时先写同目录的临时文件再 os.replace，
+    多个进程共享同一目录也不会读到不完整的文件；命中时更新文件修改时间，总大小超过
+    上限时按修改时间从旧到新删除（LRU）。命中的结果直接复制编码后的字节，不再解码、
+    渲染和编码。
+    """
+    def __init__(self, root: str, max_bytes: Optional[int] = None):
+        if max_bytes is None:
+            max_bytes = int(env_number("WATERMARK_RESULT_CACHE_MB", 1024.0, float, minimum=0) * 1024 * 1024)
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # 本进程估算的缓存大小，超过上限时重新扫描目录（其他进程也可能写入）
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+    
+    @staticmethod
+    def digest_file(path: str, chunk_size: int = 1 << 20) -> str:
+        """
+        计算输入文件内容的哈希
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def digest_image(image: Image.Image) -> str:
+        """
+        计算已解码图像的哈希（没有原始文件的图像，如已转换的 TIFF，按模式、尺寸和像素计算）
+        """
+        digest = hashlib.blake2b(repr((image.mode, image.size)).encode(), digest_size=20)
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+    
+    def key(self, input_digest: str, spec: WatermarkSpec, output_format: str, quality: int,
+            png_compression: int, **extra) -> str:
+        """
+        组合缓存键；只影响结果的参数参与计算（如 PNG 压缩级别不影响 JPEG 输出）
+        """
+        encode = {
+            "jpeg": ("quality", int(quality)), "webp": ("quality", int(quality)),
+            "png": ("compression", int(png_compression)),
+        }.get(output_format)
+        font = processor.fonts.font_path if spec.kind == "text" else None
+        fields = (RESULT_CACHE_VERSION, input_digest, tuple(spec), font, output_format, encode,
+                  tuple(sorted(extra.items())))
+        return hashlib.blake2b(repr(fields).encode(), digest_size=20).hexdigest()
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+    
+    def get(self, key: str) -> Optional[str]:
+        """
+        返回缓存文件路径并更新其最近使用时间，未命中时返回 None
+
+        只是查询，不计入命中统计；文件可能在读取前被其他进程淘汰，读取结果请使用 fetch。
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+    
+    def fetch(self, key: str, target: str) -> bool:
+        """
+        命中时把缓存的编码结果复制到 target，返回是否命中
+
+        复制成功后才计为命中；查询后、复制前被其他进程淘汰的条目计为未命中。
+        """
+        path = self.get(key)
+        if path is not None:
+            try:
+                shutil.copyfile(path, target)
+            except FileNotFoundError:
+                path = None
+        with self._lock:
+            if path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return path is not None
+    
+    def put(self, key: str, data: bytes) -> str:
+        """
+        原子写入编码结果，返回缓存文件路径
+        """
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(temp_path)
+            raise
+        
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data)
+            over_budget = self._size is None or self._size > self.max_bytes
+        if over_budget:
+            self.evict()
+        return path
+    
+    def evict(self) -> int:
+        """
+        扫描缓存目录，按修改时间从旧到新删除直到不超过上限，返回删除的文件数
+        """
+        entries = []
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                # 临时文件属于正在写入的进程，只清理残留超过一小时的
+                if entry.name.startswith(".tmp-") and time.time() - stat.st_mtime < 3600:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+                removed += 1
+            total -= size
+        with self._lock:
+            self._size = total
+        return removed
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self._size or 0,
+                    "max_bytes": self.max_bytes}
+
+
+# 每个进程按目录共享一个缓存实例
+_result_caches = {}
+
+
+def get_result_cache(root: Optional[str] = None, max_mb: Optional[float] = None) -> Optional[ResultCache]:
+    """
+    返回结果缓存，未配置目录（参数或环境变量 WATERMARK_RESULT_CACHE_DIR）时返回 None
+    """
+    root = root or os.environ.get("WATERMARK_RESULT_CACHE_DIR")
+    if not root:
+        return None
+    root = os.path.abspath(root)
+    if root not in _result_caches:
+        max_bytes = int(max_mb * 1024 * 1024) if max_mb else None
+        _result_caches[root] = ResultCache(root, max_bytes)
+    return _result_caches[root]
+
+
+def result_cache_key(cache: Optional[ResultCache], inputs, output_format: str, quality: int,
+                     png_compression: int, target_size: Optional[Tuple[int, int]] = None) -> Optional[str]:
+    """
+    由 process_watermark 的参数计算 Web 请求的缓存键，未启用缓存或参数无效时返回 None
+
+    上传文件的路径按文件内容计算哈希，不需要解码；target_size 为准入控制缩小后的尺寸。
+    """
+    if cache is None or inputs[0] is None:
+        return None
+    (image, watermark_type, text_content, text_font_size, text_color, watermark_image,
+     position_x, position_y, opacity, angle, scale, repeat_mode, spacing_x, spacing_y) = inputs
+    try:
+        watermark_rgba = None
+        if watermark_type == "图片水印" and watermark_image is not None:
+            watermark_rgba = processor.load_watermark_image(watermark_image)
+        spec = WatermarkSpec.from_params(
+            watermark_type, text_content, text_font_size, text_color, watermark_rgba,
+            position_x, position_y, opacity, angle, scale, repeat_mode, spacing_x, spacing_y
+        )
+    except ValueError:
+        return None
+    digest = ResultCache.digest_file(image) if isinstance(image, str) else ResultCache.digest_image(image)
+    extra = {"target_size": tuple(target_size)} if target_size else {}
+    return cache.key(digest, spec, output_format, quality, png_compression, **extra)
+
+
+# ---------------------------------------------------------------------------
+# 多帧图像（多页 TIFF、GIF/WebP/APNG 动画）
+# ---------------------------------------------------------------------------
+
+# 支持多帧的输出格式 -> 文件扩展名
+MULTI_FRAME_FORMATS = {"gif": ".gif", "webp": ".webp", "tiff": ".tif", "png": ".png"}
+
+# 每个多帧图像并行混合的线程数
+DEFAULT_FRAME_THREADS = env_number("WATERMARK_FRAME_THREADS", min(4, os.cpu_count() or 1), minimum=1)
+
+
+def is_multi_frame(image: Image.Image) -> bool:
+    return getattr(image, "n_frames", 1) > 1 and (image.format or "").lower() in MULTI_FRAME_FORMATS
+
+
+def iter_frames(image: Image.Image, target_size: Optional[Tuple[int, int]] = None):
+    """
+    逐帧解码并转换为 RGB，产出 (RGB 数组, 帧时长毫秒)，同一时刻只解码一帧
+
+    GIF 等依赖前一帧的格式只能顺序解码，由 Pillow 在 seek 时完成帧合成。
+    指定 target_size 时每帧按面积重采样缩小到该范围内。
+    """
+    for index in range(getattr(image, "n_frames", 1)):
+        image.seek(index)
+        with metrics.time("decode"):
+            image.load()
+        with metrics.time("convert"):
+            frame = processor.convert_image_for_display(image)
+            if target_size is not None:
+                frame = resize_to_fit(frame, target_size)
+            rgb = to_rgb_array(frame)
+        yield rgb, image.info.get("duration")
+
+
+def _apply_plan(plan: WatermarkPlan, rgb: np.ndarray, captured: Optional[list]) -> np.ndarray:
+    # 在线程池中执行，观测值并入提交方的收集
+    with metrics.capture(captured):
+        return plan.apply(rgb)
+
+
+def watermark_frames(frames, spec: WatermarkSpec, logo_rgba: Optional[np.ndarray] = None,
+                     threads: int = DEFAULT_FRAME_THREADS):
+    """
+    对帧序列应用同一个水印规格，产出 (带水印的 RGB 数组, 帧时长)
+
+    渲染计划按帧尺寸编译（通常所有帧共用一个），混合在线程池中并行执行
+    （NumPy 运算期间释放 GIL），输出保持原有顺序，同时在内存中的帧数不超过 2 × threads。
+    """
+    threads = max(1, threads)
+    captured = metrics.current_capture()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for rgb, duration in frames:
+            plan = processor.compile_plan(spec, (rgb.shape[1], rgb.shape[0]), logo_rgba)
+            pending.append((executor.submit(_apply_plan, plan, rgb, captured), duration))
+            if len(pending) >= 2 * threads:
+                future, frame_duration = pending.popleft()
+                yield future.result(), frame_duration
+        while pending:
+            future, frame_duration = pending.popleft()
+            yield future.result(), frame_duration
+
+
+def save_frames(frames, path: str, output_format: str, source_info: Optional[dict] = None,
+                quality: int = DEFAULT_QUALITY, png_compression: int = DEFAULT_PNG_COMPRESSION) -> int:
+    """
+    写出多帧图像并返回帧数，保留每帧时长、循环次数（GIF/WebP/APNG）和页结构（TIFF）
+
+    只有安装了 tifffile 时的 TIFF 逐页写入、内存中只保留当前帧；Pillow 的 GIF/WebP/APNG/TIFF
+    编码器在写出前保留全部帧（GIF 为调色板帧），内存随帧数增长，可用 buffered_frame_bytes 预先估算。
+    """
+    source_info = source_info or {}
+    if output_format == "tiff":
+        try:
+            tifffile = _require_tifffile()
+        except RuntimeError:
+            tifffile = None
+        if tifffile is not None:
+            count = 0
+            with tifffile.TiffWriter(path) as writer:
+                for rgb, _ in frames:
+                    writer.write(rgb, photometric="rgb", compression="zlib")
+                    count += 1
+            return count
+    
+    durations = []
+    
+    def images():
+        for rgb, duration in frames:
+            image = Image.fromarray(rgb)
+            if duration is not None:
+                image.info["duration"] = duration
+            durations.append(duration or 0)
+            yield image
+    
+    sequence = images()
+    first = next(sequence)
+    save_options = {"format": output_format.upper(), "save_all": True}
+    if output_format == "gif":
+        # GIF 编码器逐帧读取，时长取自每帧的 info
+        save_options["append_images"] = sequence
+    else:
+        save_options["append_images"] = list(sequence)
+        if any(durations):
+            save_options["duration"] = durations
+    if "loop" in source_info:
+        save_options["loop"] = source_info["loop"]
+    if output_format == "webp":
+        save_options["quality"] = int(quality)
+    elif output_format == "png":
+        save_options["compress_level"] = int(png_compression)
+    elif output_format == "tiff":
+        save_options["compression"] = "tiff_adobe_deflate"
+    first.save(path, **save_options)
+    return len(durations)
+
+
+def buffered_frame_bytes(size: Tuple[int, int], frame_count: int, output_format: str) -> int:
+    """
+    估算 save_frames 写出前在内存中保留的帧数据（字节），逐页写入的 TIFF 为 0
+    """
+    if output_format == "tiff":
+        try:
+            _require_tifffile()
+            return 0
+        except RuntimeError:
+            pass
+    # GIF 编码器保留量化后的调色板帧，其他格式保留 RGB 帧
+    bytes_per_pixel = 1 if output_format == "gif" else 3
+    return size[0] * size[1] * bytes_per_pixel * frame_count
+
+
+def multi_frame_output_format(requested: Optional[str], source_format: str) -> str:
+    """
+    多帧图像的输出格式：指定的格式不支持多帧时保持输入格式
+    """
+    source = source_format.lower()
+    if requested and requested.lower() != "auto":
+        output_format = resolve_output_format(requested)
+        if output_format in MULTI_FRAME_FORMATS:
+            return output_format
+        logger.warning("%s 不支持多帧，保持输入格式 %s", output_format, source)
+    return source
+
+
+# ---------------------------------------------------------------------------
+# 视频水印（解码、混合、编码三段流水线）
+# ---------------------------------------------------------------------------
+
+# 输出扩展名 -> 默认 FourCC 编码
+VIDEO_FOURCC = {".mp4": "mp4v", ".m4v": "mp4v", ".mov": "mp4v", ".avi": "MJPG", ".mkv": "XVID"}
+
+_END_OF_STREAM = object()
+
+
+def _pipeline_stage(name, work, source: queue.Queue, sink: Optional[queue.Queue], errors: list):
+    """
+    流水线的一个阶段：从 source 取出数据交给 work，结果放入 sink；
+    收到结束标记或任一阶段出错时向下游传递结束标记
+    """
+    try:
+        while not errors:
+            item = source.get()
+            if item is _END_OF_STREAM:
+                break
+            result = work(item)
+            if sink is not None:
+                sink.put(result)
+    except Exception as e:
+        logger.error("视频%s失败：%s", name, e)
+        errors.append(e)
+    finally:
+        if sink is not None:
+            sink.put(_END_OF_STREAM)
+
+
+def watermark_video(source: str, target: str, spec: WatermarkSpec, logo_rgba: Optional[np.ndarray] = None,
+                    fourcc: Optional[str] = None, queue_size: int = 8) -> Tuple[int, float]:
+    """
+    为视频逐帧添加水印，返回 (帧数, 耗时秒)
+
+    水印只按画面尺寸编译一次渲染计划，每帧原地混合。解码、混合、编码分别在独立线程中
+    执行（OpenCV 编解码和 NumPy 混合都会释放 GIL），阶段之间用长度为 queue_size 的队列
+    连接，内存中的帧数有上限。只处理画面，音轨不会被保留；不依赖图形界面，可在无显示器、
+    无 GPU 的服务器上运行（可使用 opencv-python-headless）。
+    """
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise RuntimeError(f"无法打开视频：{source}")
+    
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fourcc = fourcc or VIDEO_FOURCC.get(os.path.splitext(target)[1].lower(), "mp4v")
+    writer = cv2.VideoWriter(target, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+    if not writer.isOpened():
+        capture.release()
+        raise RuntimeError(f"无法创建视频：{target}（编码 {fourcc}）")
+    
+    plan = processor.compile_plan(spec, (width, height), logo_rgba)
+    decoded = queue.Queue(maxsize=max(2, queue_size))
+    blended = queue.Queue(maxsize=max(2, queue_size))
+    errors = []
+    frame_count = 0
+    
+    def read_frames():
+        try:
+            while not errors:
+                with metrics.time("decode"):
+                    ok, frame = capture.read()
+                if not ok:
+                    break
+                decoded.put(frame)
+        except Exception as e:
+            logger.error("视频解码失败：%s", e)
+            errors.append(e)
+        finally:
+            decoded.put(_END_OF_STREAM)
+    
+    def blend(frame):
+        # OpenCV 帧为 BGR，原地转换为 RGB 混合后再转换回去
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+        plan.apply(frame)
+        cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst=frame)
+        return frame
+    
+    def write(frame):
+        nonlocal frame_count
+        with metrics.time("encode"):
+            writer.write(frame)
+        frame_count += 1
+    
+    start = time.perf_counter()
+    threads = [
+        threading.Thread(target=read_frames, name="video-decode", daemon=True),
+        threading.Thread(target=_pipeline_stage, args=("混合", blend, decoded, blended, errors),
+                         name="video-blend", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        _pipeline_stage("编码", write, blended, None, errors)
+    finally:
+        if errors:
+            # 出错时清空队列，让仍在阻塞的上游线程退出
+            for pending in (decoded, blended):
+                while True:
+                    try:
+                        pending.get_nowait()
+                    except queue.Empty:
+                        break
+        for thread in threads:
+            thread.join()
+        capture.release()
+        writer.release()
+    
+    if errors:
+        raise errors[0]
+    return frame_count, time.perf_counter() - start
+
+
+# ---------------------------------------------------------------------------
+# 超大 TIFF 流式处理（按条带读写，内存占用与图像尺寸无关）
+# ---------------------------------------------------------------------------
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def _require_tifffile():
+    try:
+        import tifffile
+    except ImportError as e:
+        raise RuntimeError("TIFF 流式处理需要安装 tifffile（压缩格式还需要 imagecodecs）") from e
+    return tifffile
+
+
+# Image.MAX_IMAGE_PIXELS 是进程全局设置，临时修改时加锁
+_PIL_LIMIT_LOCK = threading.Lock()
+
+
+def pillow_pixel_limit() -> Optional[int]:
+    """
+    Pillow 打开图片时直接拒绝的像素数（解压炸弹保护，为 MAX_IMAGE_PIXELS 的 2 倍），不限制时返回 None
+    """
+    return 2 * Image.MAX_IMAGE_PIXELS if Image.MAX_IMAGE_PIXELS else None
+
+
+def tiff_header_info(path: str) -> Tuple[int, int]:
+    """
+    只读取 TIFF 文件头，返回 (第一页的像素数, 页数)，不受 Pillow 解压炸弹上限的限制
+
+    优先使用 tifffile；没有安装时用 Pillow 读取文件头，并临时取消只在打开时进行的像素数检查。
+    """
+    try:
+        import tifffile
+    except ImportError:
+        with _PIL_LIMIT_LOCK:
+            limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+            try:
+                with Image.open(path) as image:
+                    return image.width * image.height, getattr(image, "n_frames", 1)
+            finally:
+                Image.MAX_IMAGE_PIXELS = limit
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        return page.imagewidth * page.imagelength, len(tif.pages)
+
+
+class TiffStripReader:
+    """
+    按行区间读取 TIFF 第一页的 RGB 数据，只解码与区间相交的条带/瓦片
+
+    未压缩的连续数据直接内存映射；压缩数据按段（strip/tile）解码。
+    """
+    def __init__(self, path: str):
+        tifffile = _require_tifffile()
+        self._tif = tifffile.TiffFile(path)
+        page = self._tif.pages[0]
+        self.page = page
+        self.height, self.width = page.imagelength, page.imagewidth
+        
+        if page.dtype != np.uint8:
+            self.close()
+            raise ValueError(f"流式模式仅支持 8 位 TIFF，当前为 {page.dtype}")
+        if page.samplesperpixel > 1 and page.planarconfig != 1:
+            self.close()
+            raise ValueError("流式模式不支持平面分离存储 (PlanarConfiguration=2) 的 TIFF")
+        
+        self._memmap = None
+        if page.is_memmappable:
+            self._memmap = tifffile.memmap(path, page=0, mode='r')
+            self.segment_rows = self.height
+        elif page.is_tiled:
+            self.segment_rows, self._segment_cols = page.tilelength, page.tilewidth
+        else:
+            self.segment_rows, self._segment_cols = min(page.rowsperstrip, self.height), self.width
+        
+        if self._memmap is None:
+            self._segments_across = -(-self.width // self._segment_cols)
+            if self.segment_rows >= self.height and self.height > 1024:
+                logger.warning("该 TIFF 只有一个压缩条带，无法分块读取，将整体解码")
+    
+    def close(self) -> None:
+        self._memmap = None
+        self._tif.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def _read_raw(self, y0: int, y1: int) -> np.ndarray:
+        if self._memmap is not None:
+            return np.array(self._memmap[y0:y1])
+        
+        page = self.page
+        samples = page.samplesperpixel
+        raw = np.zeros((y1 - y0, self.width, samples), dtype=np.uint8)
+        first, last = y0 // self.segment_rows, (y1 - 1) // self.segment_rows
+        indices = [
+            row * self._segments_across + col
+            for row in range(first, last + 1)
+            for col in range(self._segments_across)
+        ]
+        segments = self._tif.filehandle.read_segments(
+            [page.dataoffsets[i] for i in indices],
+            [page.databytecounts[i] for i in indices],
+            indices=indices
+        )
+        for data, index in segments:
+            segment, position, _ = page.decode(data, index, jpegtables=page.jpegtables)
+            if segment is None:
+                continue
+            segment = segment.reshape(segment.shape[-3:])
+            seg_y, seg_x = position[2], position[3]
+            top, bottom = max(seg_y, y0), min(seg_y + segment.shape[0], y1)
+            right = min(seg_x + segment.shape[1], self.width)
+            raw[top - y0:bottom - y0, seg_x:right] = segment[top - seg_y:bottom - seg_y, :right - seg_x]
+        return raw
+    
+    def read_rgb(self, y0: int, y1: int) -> np.ndarray:
+        """
+        读取 [y0, y1) 行并转换为可写的 RGB uint8 数组
+        """
+        raw = self._read_raw(y0, y1)
+        if raw.ndim == 2:
+            raw = raw[..., None]
+        
+        photometric = int(self.page.photometric)
+        if photometric == 2 or (photometric == 6 and raw.shape[2] >= 3):
+            # RGB（JPEG 压缩的 YCbCr 已由解码器转换为 RGB），忽略额外通道
+            return np.ascontiguousarray(raw[..., :3])
+        if photometric in (0, 1):
+            gray = raw[..., 0]
+            if photometric == 0:
+                gray = 255 - gray
+            return np.repeat(gray[..., None], 3, axis=2)
+        if photometric == 3:
+            palette = (np.asarray(self.page.colormap) >> 8).astype(np.uint8).T
+            return palette[raw[..., 0]]
+        if photometric == 5 and raw.shape[2] >= 4:
+            # CMYK -> RGB：(255 - C) × (255 - K) / 255
+            inverse_k = 255 - raw[..., 3:4].astype(np.uint16)
+            return ((255 - raw[..., :3].astype(np.uint16)) * inverse_k // 255).astype(np.uint8)
+        raise ValueError(f"流式模式不支持的 TIFF 颜色类型：{self.page.photometric!r}")
+
+
+def stream_watermark_tiff(source: str, target: str, layer_factory, band_rows: int = 1024,
+                          compression: Optional[str] = 'zlib', tile_size: int = 256) -> Tuple[int, int]:
+    """
+    按条带读取 TIFF、添加水印并以瓦片 TIFF 写出，峰值内存约为一个条带的大小
+
+    layer_factory 接收画布尺寸 (宽, 高)，返回带 blend_region 方法的水印层；
+    每个条带以其在整幅画布中的坐标混合，重复水印的网格跨条带保持连续。
+    返回 (宽, 高)。
+    """
+    tifffile = _require_tifffile()
+    # 条带高度取瓦片高度的整数倍，保证每个条带正好输出整行瓦片
+    rows_per_band = max(1, band_rows // tile_size) * tile_size
+    
+    with TiffStripReader(source) as reader:
+        width, height = reader.width, reader.height
+        layer = layer_factory((width, height))
+        
+        def watermarked_tiles():
+            for y0 in range(0, height, rows_per_band):
+                with metrics.time("decode"):
+                    band = reader.read_rgb(y0, min(height, y0 + rows_per_band))
+                with metrics.time("composite"):
+                    blend_layer(layer, band, 0, y0)
+                for tile_y in range(0, band.shape[0], tile_size):
+                    for tile_x in range(0, width, tile_size):
+                        yield band[tile_y:tile_y + tile_size, tile_x:tile_x + tile_size]
+        
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        tifffile.imwrite(
+            target, watermarked_tiles(), shape=(height, width, 3), dtype=np.uint8,
+            tile=(tile_size, tile_size), photometric='rgb', compression=compression,
+            bigtiff=width * height * 3 > 2 ** 31
+        )
+    return width, height
+
+
+# ---------------------------------------------------------------------------
+# 批处理命令行（不依赖 Gradio）
+# ---------------------------------------------------------------------------
+
+
+
+def collect_batch_inputs(inputs, recursive: bool = True):
+    """
+    展开输入的文件和目录，返回 (源文件路径, 相对输出路径) 列表
+    """
+    supported = tuple(processor.supported_formats)
+    jobs = []
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            for root, dirs, files in os.walk(input_path):
+                if not recursive:
+                    dirs[:] = []
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(supported):
+                        source = os.path.join(root, name)
+                        jobs.append((source, os.path.relpath(source, input_path)))
+        elif os.path.isfile(input_path):
+            jobs.append((input_path, os.path.basename(input_path)))
+        else:
+            print(f"输入不存在，已跳过：{input_path}")
+    return jobs
+
+
+def _options_logo(options):
+    # 每个进程只解码一次水印图片（LogoRegistry 按路径记住内容指纹）
+    if options["type"] == "image" and options["logo"]:
+        return processor.load_watermark_image(options["logo"])
+    return None
+
+
+def spec_from_options(options) -> WatermarkSpec:
+    """
+    由命令行选项构建水印规格，整个批次只校验一次，参数无效时抛出 ValueError
+    """
+    return WatermarkSpec.from_params(
+        options["type"], options["text"], options["font_size"], options["color"],
+        _options_logo(options), options["x"], options["y"], options["opacity"],
+        options["angle"], options["scale"], options["repeat"],
+        options["spacing_x"], options["spacing_y"]
+    )
+
+
+def _stream_layer_factory(spec, options):
+    watermark_rgba = _options_logo(options)
+    return lambda canvas_size: processor.compile_layer(spec, canvas_size, watermark_rgba)
+
+
+def _batch_worker(job):
+    """
+    在工作进程中处理单张图片，返回 (源路径, 输入字节数, 错误信息, 阶段耗时)
+    """
+    source, target, options, spec = job
+    with metrics.capture() as observations:
+        try:
+            run_profiled("batch", _batch_process_one, source, target, options, spec)
+            return source, os.path.getsize(source), None, observations
+        except Exception as e:
+            return source, 0, str(e), observations
+
+
+def _output_path(target: str, output_format: str, extensions: dict) -> str:
+    # 输出扩展名与实际格式保持一致（如 GIF 输入或指定 --format 时）
+    root, extension = os.path.splitext(target)
+    extension = extension.lower()
+    if _EXTENSION_FORMATS.get(extension, extension.lstrip(".")) != output_format:
+        target = root + extensions[output_format]
+    return target
+
+
+def _batch_cache_key(cache: Optional[ResultCache], source, options, spec, output_format):
+    if cache is None:
+        return None
+    return cache.key(ResultCache.digest_file(source), spec, output_format, options["quality"],
+                     options["png_compression"], max_side=options["max_side"])
+
+
+def _batch_process_one(source, target, options, spec) -> str:
+    """
+    处理单张图片并写出结果，返回实际的输出路径（扩展名可能随输出格式改变）
+    """
+    target_size = (options["max_side"], options["max_side"]) if options["max_side"] else None
+    cache = get_result_cache(options["cache_dir"], options["cache_mb"]) if options.get("cache_dir") else None
+    
+    # 超过阈值的单页 TIFF 走流式处理，避免整幅解码（结果不缓存）；在打开前只按文件头判断，
+    # Pillow 会拒绝打开的超大 TIFF 同样流式处理
+    if source.lower().endswith(TIFF_EXTENSIONS):
+        pixels, pages = tiff_header_info(source)
+        limit = pillow_pixel_limit()
+        if pages == 1 and (pixels >= options["stream_pixels"] or (limit and pixels > limit)):
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            stream_watermark_tiff(source, target, _stream_layer_factory(spec, options))
+            return target
+    
+    with Image.open(source) as image:
+        source_format = image.format
+        if is_multi_frame(image):
+            # 多帧图像逐帧处理，所有帧共用一个渲染计划
+            output_format = multi_frame_output_format(options["format"], source_format)
+            target = _output_path(target, output_format, MULTI_FRAME_FORMATS)
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            cache_key = _batch_cache_key(cache, source, options, spec, output_format)
+            if cache_key and cache.fetch(cache_key, target):
+                return target
+            budget = options.get("frame_memory", 0)
+            frame_size = fit_size(image.size, target_size) if target_size else image.size
+            buffered = buffered_frame_bytes(frame_size, image.n_frames, output_format)
+            if budget and buffered > budget:
+                raise ValueError(
+                    f"输出为 {output_format} 时需要在内存中保留全部 {image.n_frames} 帧"
+                    f"（约 {buffered / 2**20:.0f} MB），超过每个工作进程的内存上限 {budget / 2**20:.0f} MB；"
+                    f"可改用 --format tiff（安装 tifffile 后逐页写出）、--max-side 缩小，或调大 --inflight-memory-mb"
+                )
+            frames = watermark_frames(iter_frames(image, target_size), spec,
+                                      _options_logo(options), options["frame_threads"])
+            save_frames(frames, target, output_format, dict(image.info),
+                        options["quality"], options["png_compression"])
+            if cache_key:
+                with open(target, "rb") as f:
+                    cache.put(cache_key, f.read())
+            return target
+        
+        output_format = resolve_output_format(options["format"], source_format, source)
+        target = _output_path(target, output_format, OUTPUT_FORMATS)
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        cache_key = _batch_cache_key(cache, source, options, spec, output_format)
+        if cache_key and cache.fetch(cache_key, target):
+            return target
+        if target_size is None:
+            with metrics.time("decode"):
+                image.load()
+            with metrics.time("convert"):
+                rgb_image = to_rgb_array(processor.convert_image_for_display(image))
+    
+    if target_size is not None:
+        # 缩小输出时按目标尺寸解码（JPEG 在 DCT 域缩小）
+        rgb_image = to_rgb_array(processor.load_and_convert_image(source, target_size))
+    
+    # 同尺寸的图片复用同一个渲染计划
+    height, width = rgb_image.shape[:2]
+    result = processor.compile_plan(spec, (width, height), _options_logo(options)).apply(rgb_image)
+    
+    data = encode_image(result, output_format, options["quality"], options["png_compression"])
+    with open(target, "wb") as f:
+        f.write(data)
+    if cache_key:
+        cache.put(cache_key, data)
+    return target
+
+
+def run_batch(args) -> int:
+    """
+    批量添加水印，按进程池并行处理并在结束时输出吞吐量
+    """
+    jobs = collect_batch_inputs(args.inputs, recursive=not args.no_recursive)
+    if not jobs:
+        print("没有找到可处理的图片")
+        return 1
+    
+    options = options_from_args(args)
+    options["stream_pixels"] = int(args.stream_threshold * 1_000_000)
+    options.update(format=args.format, quality=args.quality, png_compression=args.png_compression,
+                   max_side=args.max_side, frame_threads=args.frame_threads,
+                   cache_dir=args.result_cache, cache_mb=args.result_cache_mb,
+                   frame_memory=int(args.inflight_memory_mb * 1024 * 1024 / max(1, args.workers)))
+    try:
+        spec = spec_from_options(options)
+    except ValueError as e:
+        print(f"水印参数无效：{e}")
+        return 2
+    tasks = [
+        (source, os.path.join(args.output, relative), options, spec)
+        for source, relative in jobs
+    ]
+    
+    # 多个工作进程时平分 CPU 核，避免每个进程都开满条带并行线程
+    os.environ.setdefault("WATERMARK_COMPOSITE_THREADS", str(max(1, (os.cpu_count() or 1) // max(1, args.workers))))
+    print(f"批处理：{len(tasks)} 张图片，{args.workers} 个工作进程，输出目录 {args.output}")
+    start = time.perf_counter()
+    done = failed = total_bytes = 0
+    
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(args.log_level,)) as executor:
+        futures = [executor.submit(_batch_worker, task) for task in tasks]
+        for future in as_completed(futures):
+            source, size, error, observations = future.result()
+            metrics.observe_many(observations)
+            if error:
+                failed += 1
+                print(f"处理失败 {source}: {error}")
+            else:
+                done += 1
+                total_bytes += size
+                if args.verbose:
+                    print(f"完成 {source}")
+    
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(
+        f"完成 {done} 张，失败 {failed} 张，耗时 {elapsed:.2f}s，"
+        f"{done / elapsed:.2f} 张/s，{total_bytes / elapsed / (1024 * 1024):.2f} MB/s"
+    )
+    if args.verbose:
+        for stage, (count, total) in sorted(metrics.summary().items()):
+            print(f"  {stage:<15} {count:>6} 次  平均 {total / count * 1000:8.2f} ms")
+    return 0 if failed == 0 else 1
+
+
+def run_stream(args) -> int:
+    """
+    流式处理单个超大 TIFF
+    """
+    options = options_from_args(args)
+    try:
+        spec = spec_from_options(options)
+    except ValueError as e:
+        print(f"水印参数无效：{e}")
+        return 2
+    start = time.perf_counter()
+    width, height = stream_watermark_tiff(
+        args.input, args.output, _stream_layer_factory(spec, options),
+        band_rows=args.band_rows, compression=None if args.compression == "none" else args.compression
+    )
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"完成 {width}x{height}，耗时 {elapsed:.2f}s，{width * height / elapsed / 1e6:.1f} MP/s")
+    return 0
+
+
+def run_video(args) -> int:
+    """
+    为单个视频添加水印并输出帧率
+    """
+    options = options_from_args(args)
+    try:
+        spec = spec_from_options(options)
+    except ValueError as e:
+        print(f"水印参数无效：{e}")
+        return 2
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    try:
+        frames, elapsed = watermark_video(args.input, args.output, spec, _options_logo(options),
+                                          fourcc=args.fourcc, queue_size=args.queue_size)
+    except RuntimeError as e:
+        print(e)
+        return 1
+    elapsed = max(elapsed, 1e-9)
+    print(f"完成 {frames} 帧，耗时 {elapsed:.2f}s，{frames / elapsed:.1f} 帧/s")
+    if args.verbose:
+        for stage, (count, total) in sorted(metrics.summary().items()):
+            print(f"  {stage:<15} {count:>6} 次  平均 {total / count * 1000:8.2f} ms")
+    return 0
+
+
+def options_from_args(args) -> dict:
+    return {
+        "type": args.type, "text": args.text, "font_size": args.font_size,
+        "color": args.color, "logo": args.logo, "x": args.x, "y": args.y,
+        "opacity": args.opacity, "angle": args.angle, "scale": args.scale,
+        "repeat": args.repeat, "spacing_x": args.spacing_x, "spacing_y": args.spacing_y,
+    }
+
+
+def add_watermark_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    添加水印参数（各命令行子命令共用），默认值与 Web 界面一致
+    """
+    parser.add_argument("--type", choices=sorted(WATERMARK_TYPES), default="text", help="水印类型")
+    parser.add_argument("--text", default="WATERMARK", help="水印文字")
+    parser.add_argument("--font-size", type=int, default=40, help="字体大小")
+    parser.add_argument("--color", default="#FF4757", help="文字颜色")
+    parser.add_argument("--logo", help="水印图片路径（--type image 时必需）")
+    parser.add_argument("--x", type=int, default=100, help="水平位置 (px)")
+    parser.add_argument("--y", type=int, default=100, help="垂直位置 (px)")
+    parser.add_argument("--opacity", type=float, default=0.4, help="透明度")
+    parser.add_argument("--angle", type=float, default=-30, help="旋转角度 (°)")
+    parser.add_argument("--scale", type=float, default=0.2, help="图片水印大小比例")
+    parser.add_argument("--no-repeat", dest="repeat", action="store_false", help="关闭重复水印模式，只添加单个水印")
+    parser.add_argument("--spacing-x", type=int, default=150, help="水平间距")
+    parser.add_argument("--spacing-y", type=int, default=100, help="垂直间距")
+
+
+def add_encode_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    添加输出编码参数
+    """
+    parser.add_argument("--format", choices=["auto"] + sorted(OUTPUT_FORMATS),
+                        default=os.environ.get("WATERMARK_OUTPUT_FORMAT", "auto"),
+                        help="输出格式，auto 表示与输入格式一致")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY, help="JPEG/WebP 质量 (1-100)")
+    parser.add_argument("--png-compression", type=int, default=DEFAULT_PNG_COMPRESSION, choices=range(10),
+                        metavar="0-9", help="PNG 压缩级别，越小编码越快、文件越大")
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    """
+    命令行参数：无子命令时启动 Web 界面，batch 子命令执行批处理，stream 子命令流式处理超大 TIFF，
+    video 子命令为视频添加水印，watch 子命令以热文件夹守护进程方式运行
+    """
+    parser = argparse.ArgumentParser(description="图片水印添加工具")
+    # Web 界面参数，也可通过环境变量配置
+    parser.add_argument("--host", default=os.environ.get("WATERMARK_HOST", "0.0.0.0"), help="监听地址")
+    parser.add_argument("--port", type=int, default=env_number("WATERMARK_PORT", 7860, minimum=0, maximum=65535), help="监听端口")
+    parser.add_argument("--workers", type=int, default=env_number("WATERMARK_WORKERS", os.cpu_count() or 1, minimum=0),
+                        help="处理水印的工作进程数，0 表示在 Web 进程内直接处理")
+    parser.add_argument("--queue-depth", type=int, default=env_number("WATERMARK_QUEUE_DEPTH", 64, minimum=0),
+                        help="最多排队等待的请求数，超出时提示服务繁忙")
+    parser.add_argument("--job-timeout", type=float, default=env_number("WATERMARK_JOB_TIMEOUT", 120.0, float, minimum=0),
+                        help="单个请求的处理超时（秒），0 表示不限制")
+    parser.add_argument("--metrics-port", type=int, default=env_number("WATERMARK_METRICS_PORT", 0, minimum=0, maximum=65535),
+                        help="Prometheus 指标接口端口（/metrics），0 表示不开启")
+    parser.add_argument("--log-level", default=os.environ.get("WATERMARK_LOG_LEVEL", "WARNING"),
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"], type=str.upper, help="日志级别")
+    parser.add_argument("--profile-dir", default=os.environ.get("WATERMARK_PROFILE_DIR"),
+                        help="为每个请求保存 cProfile 结果（.prof）到该目录，用于深入分析")
+    parser.add_argument("--preload-logo", action="append", default=[], metavar="PATH",
+                        help="启动时预加载的水印图片，可重复指定（也可用 WATERMARK_PRELOAD_LOGOS）")
+    parser.add_argument("--composite-threads", type=int, default=None,
+                        help="单张大图按条带并行混合和转换的线程数（默认 CPU 核数，使用多个工作进程时除以工作进程数；"
+                             "也可用 WATERMARK_COMPOSITE_THREADS），1 表示不并行")
+    parser.add_argument("--result-cache", default=os.environ.get("WATERMARK_RESULT_CACHE_DIR"), metavar="DIR",
+                        help="水印结果的磁盘缓存目录，相同图片和参数再次处理时直接返回缓存结果，可由多个进程共享")
+    parser.add_argument("--result-cache-mb", type=float,
+                        default=env_number("WATERMARK_RESULT_CACHE_MB", 1024.0, float, minimum=0),
+                        help="结果缓存的大小上限（MB），超出时删除最久未使用的结果")
+    parser.add_argument("--max-megapixels", type=float,
+                        default=env_number("WATERMARK_MAX_MEGAPIXELS", 100.0, float, minimum=0),
+                        help="Web 上传图片的像素上限（百万），只读取文件头判断，0 表示不限制")
+    parser.add_argument("--oversize", choices=OVERSIZE_POLICIES,
+                        default=os.environ.get("WATERMARK_OVERSIZE_POLICY", "downscale"),
+                        help="超过像素上限的图片：downscale 解码时按比例缩小，reject 直接拒绝")
+    parser.add_argument("--inflight-memory-mb", type=float,
+                        default=env_number("WATERMARK_INFLIGHT_MEMORY_MB", 4096.0, float, minimum=0),
+                        help="同时处理中的 Web 请求估算内存总量上限（MB），超出时排队；批处理和热文件夹中按工作进程"
+                             "平分，限制需要在内存中保留全部帧的多帧输出；0 表示不限制")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    batch = subparsers.add_parser("batch", help="批量处理目录或文件列表")
+    batch.add_argument("inputs", nargs="+", help="输入图片文件或目录")
+    batch.add_argument("-o", "--output", required=True, help="输出目录")
+    batch.add_argument("--no-recursive", action="store_true", help="不递归处理子目录")
+    batch.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="工作进程数")
+    batch.add_argument("--stream-threshold", type=float, default=200,
+                       help="像素数（百万）达到该值的 TIFF 使用流式处理")
+    batch.add_argument("--max-side", type=int, default=0,
+                       help="输出的最长边（像素），超过时按比例缩小，0 表示保持原尺寸（流式处理的 TIFF 不缩小）")
+    batch.add_argument("--frame-threads", type=int, default=DEFAULT_FRAME_THREADS,
+                       help="多帧图像（多页 TIFF、GIF/WebP 动画）每张并行混合的线程数")
+    batch.add_argument("-v", "--verbose", action="store_true", help="输出每张图片的处理结果")
+    add_encode_arguments(batch)
+    add_watermark_arguments(batch)
+    
+    stream = subparsers.add_parser("stream", help="按条带流式处理超大 TIFF，内存占用有上限")
+    stream.add_argument("input", help="输入 TIFF 文件")
+    stream.add_argument("-o", "--output", required=True, help="输出 TIFF 文件")
+    stream.add_argument("--band-rows", type=int, default=1024, help="每个条带的行数")
+    stream.add_argument("--compression", choices=["zlib", "lzw", "none"], default="zlib",
+                        help="输出压缩方式（lzw 需要 imagecodecs）")
+    add_watermark_arguments(stream)
+    
+    watch = subparsers.add_parser("watch", help="热文件夹守护进程：监视输入目录，增量处理新增或修改的图片")
+    watch.add_argument("input", help="监视的输入目录")
+    watch.add_argument("-o", "--output", required=True, help="输出目录（结果原子移动到此处）")
+    watch.add_argument("--manifest", help="SQLite 清单路径，默认为输出目录下的 .watermark-manifest.sqlite3")
+    watch.add_argument("--no-recursive", action="store_true", help="不监视子目录")
+    watch.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="工作进程数")
+    watch.add_argument("--settle", type=float, default=2.0,
+                       help="文件最后修改后至少经过的秒数，避免处理仍在写入的文件")
+    watch.add_argument("--poll-interval", type=float, default=2.0, help="无法使用 inotify 时的扫描间隔（秒）")
+    watch.add_argument("--rescan-interval", type=float, default=300.0,
+                       help="使用 inotify 时完整扫描兜底的间隔（秒）")
+    watch.add_argument("--no-inotify", action="store_true", help="不使用 inotify，始终定期扫描（如网络文件系统）")
+    watch.add_argument("--once", action="store_true", help="处理完现有的新增或修改文件后退出，不持续监视")
+    watch.add_argument("--stream-threshold", type=float, default=200,
+                       help="像素数（百万）达到该值的 TIFF 使用流式处理")
+    watch.add_argument("--max-side", type=int, default=0, help="输出的最长边（像素），0 表示保持原尺寸")
+    watch.add_argument("--frame-threads", type=int, default=DEFAULT_FRAME_THREADS,
+                       help="多帧图像每张并行混合的线程数")
+    watch.add_argument("-v", "--verbose", action="store_true", help="输出每个文件的处理结果")
+    add_encode_arguments(watch)
+    add_watermark_arguments(watch)
+    
+    video = subparsers.add_parser("video", help="为视频逐帧添加水印（不保留音轨）")
+    video.add_argument("input", help="输入视频文件")
+    video.add_argument("-o", "--output", required=True, help="输出视频文件")
+    video.add_argument("--fourcc", help="输出编码 FourCC（如 mp4v、MJPG、XVID），默认按扩展名选择")
+    video.add_argument("--queue-size", type=int, default=8, help="解码、混合、编码各阶段之间最多缓冲的帧数")
+    video.add_argument("-v", "--verbose", action="store_true", help="输出各阶段平均耗时")
+    add_watermark_arguments(video)
+    return parser
+
+
+# ---------------------------------------------------------------------------
+# 热文件夹守护进程（监视输入目录，增量处理新增或修改的文件）
+# ---------------------------------------------------------------------------
+
+class WatchManifest:
+    """
+    记录热文件夹处理情况的 SQLite 清单：相对路径、大小、修改时间、内容哈希、水印设置指纹和结果
+
+    守护进程重启后据此跳过没有变化的文件；只有修改时间变化而内容哈希相同的文件不会重新处理，
+    处理失败的文件在内容或设置变化前不会重试。清单只在守护进程的主线程中访问。
+    """
+    _FIELDS = ("size", "mtime_ns", "digest", "settings", "status", "output")
+    
+    def __init__(self, path: str):
+        import sqlite3
+        
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT, settings TEXT, "
+            "status TEXT, output TEXT, error TEXT, updated REAL)"
+        )
+        self.connection.commit()
+    
+    def get(self, path: str) -> Optional[dict]:
+        row = self.connection.execute(
+            f"SELECT {', '.join(self._FIELDS)} FROM files WHERE path = ?", (path,)
+        ).fetchone()
+        return dict(zip(self._FIELDS, row)) if row is not None else None
+    
+    def record(self, path: str, size: int, mtime_ns: int, digest: Optional[str], settings: str,
+               status: str, output: Optional[str] = None, error: Optional[str] = None) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, size, mtime_ns, digest, settings, status, output, error, time.time())
+        )
+        self.connection.commit()
+    
+    def counts(self) -> dict:
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM files GROUP BY status"))
+    
+    def close(self) -> None:
+        self.connection.close()
+
+
+class _Inotify:
+    """
+    通过 ctypes 调用 Linux inotify，不依赖第三方库
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    _EVENT = struct.Struct("iIII")
+    
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("当前系统不支持 inotify")
+        self._libc = libc
+        self._get_errno = ctypes.get_errno
+        # IN_NONBLOCK / IN_CLOEXEC 与 O_NONBLOCK / O_CLOEXEC 取值相同
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self._get_errno(), "inotify_init1 失败")
+        self._directories = {}
+    
+    def add(self, directory: str) -> bool:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            logger.warning("无法监视目录 %s：%s", directory, os.strerror(self._get_errno()))
+            return False
+        self._directories[wd] = directory
+        return True
+    
+    def read(self, timeout: float) -> list:
+        """
+        等待最多 timeout 秒，返回 [(路径, 事件掩码)]；事件队列溢出时路径为 None
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self._EVENT.size <= len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            directory = self._directories.get(wd)
+            if directory is not None and name:
+                events.append((os.path.join(directory, os.fsdecode(name)), mask))
+        return events
+    
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    """
+    监视目录中新增或修改的图片
+
+    Linux 上使用 inotify（文件写入关闭或移入目录时触发），不可用时（其他系统、监视数量
+    超限等）退回每 poll_interval 秒扫描一次。inotify 模式也会每 rescan_interval 秒做一次完整
+    扫描兜底（如网络文件系统上漏掉的事件），事件队列溢出时立即扫描。
+    changes() 返回自上次调用以来可能变化的文件路径。
+    """
+    def __init__(self, root: str, recursive: bool = True, poll_interval: float = 2.0,
+                 rescan_interval: float = 300.0, use_inotify: bool = True, exclude=()):
+        self.root = root
+        self.recursive = recursive
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.exclude = tuple(os.path.join(os.path.abspath(path), "") for path in exclude)
+        self._supported = tuple(processor.supported_formats)
+        self._snapshot = {}
+        self._next_scan = 0.0
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify()
+            except (OSError, AttributeError) as e:
+                logger.warning("inotify 不可用，改用定期扫描：%s", e)
+        self.mode = "inotify" if self._inotify is not None else "polling"
+    
+    def _included(self, path: str) -> bool:
+        name = os.path.basename(path)
+        return (not name.startswith(".") and name.lower().endswith(self._supported)
+                and not os.path.join(os.path.abspath(path), "").startswith(self.exclude))
+    
+    def _walk(self, directory: str):
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [
+                name for name in dirs
+                if self.recursive and not name.startswith(".")
+                and not os.path.join(os.path.abspath(os.path.join(root, name)), "").startswith(self.exclude)
+            ]
+            if self._inotify is not None:
+                # 重复添加同一目录只会更新监视，不会产生重复事件
+                self._inotify.add(root)
+            for name in files:
+                path = os.path.join(root, name)
+                if self._included(path):
+                    yield path
+    
+    def scan(self, directory: Optional[str] = None) -> set:
+        """
+        扫描目录，返回大小或修改时间与上次扫描不同的文件
+        """
+        changed = set()
+        for path in self._walk(directory or self.root):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self._snapshot.get(path) != signature:
+                self._snapshot[path] = signature
+                changed.add(path)
+        return changed
+    
+    def changes(self, timeout: float = 1.0) -> set:
+        now = time.monotonic()
+        if now >= self._next_scan:
+            self._next_scan = now + (self.rescan_interval if self._inotify is not None else self.poll_interval)
+            return self.scan()
+        
+        wait = min(timeout, self._next_scan - now)
+        if self._inotify is None:
+            time.sleep(wait)
+            return set()
+        changed = set()
+        for path, mask in self._inotify.read(wait):
+            if path is None:
+                logger.warning("inotify 事件队列溢出，重新扫描输入目录")
+                self._next_scan = 0.0
+            elif mask & _Inotify.IN_ISDIR:
+                # 新建或移入的子目录：添加监视并扫描已有文件
+                if self.recursive and not path.startswith(self.exclude):
+                    changed |= self.scan(path)
+            elif mask & (_Inotify.IN_CLOSE_WRITE | _Inotify.IN_MOVED_TO) and self._included(path):
+                changed.add(path)
+        return changed
+    
+    def close(self) -> None:
+        if self._inotify is not None:
+            self._inotify.close()
+
+
+def _init_watch_worker(log_level: str = "WARNING") -> None:
+    # 停止信号只由守护进程处理：工作进程完成手头的任务，随进程池关闭退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    init_worker(log_level)
+
+
+def _watch_worker(job):
+    """
+    在工作进程中处理热文件夹中的一个文件，返回 (内容哈希, 输出路径, 错误信息, 阶段耗时)
+
+    内容哈希与上次成功处理时相同（只是修改时间变化）时直接返回，输出路径为 None。
+    结果先写入输出目录下的暂存目录，再用 os.replace 原子移动到最终位置。
+    """
+    source, relative, output_root, options, spec, previous_digest = job
+    with metrics.capture() as observations:
+        try:
+            digest = ResultCache.digest_file(source)
+            if digest == previous_digest:
+                return digest, None, None, observations
+            staging = tempfile.mkdtemp(prefix=".staging-", dir=output_root)
+            try:
+                staged = run_profiled("watch", _batch_process_one, source, os.path.join(staging, relative),
+                                      options, spec)
+                target = os.path.join(output_root, os.path.relpath(staged, staging))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(staged, target)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            return digest, target, None, observations
+        except Exception as e:
+            return None, None, str(e), observations
+
+
+def _watch_settings(spec: WatermarkSpec, options: dict) -> str:
+    # 影响输出的设置变化后，已处理的文件会重新处理
+    settings = (tuple(spec), processor.fonts.font_path, options["format"], options["quality"],
+                options["png_compression"], options["max_side"])
+    return hashlib.blake2b(repr(settings).encode(), digest_size=16).hexdigest()
+
+
+def run_watch(args) -> int:
+    """
+    热文件夹守护进程：监视输入目录，用进程池增量处理新增或修改的图片
+
+    收到 SIGINT/SIGTERM 后不再提交新任务，等待进行中的任务完成并写入清单后退出。
+    """
+    options = options_from_args(args)
+    options["stream_pixels"] = int(args.stream_threshold * 1_000_000)
+    options.update(format=args.format, quality=args.quality, png_compression=args.png_compression,
+                   max_side=args.max_side, frame_threads=args.frame_threads,
+                   cache_dir=args.result_cache, cache_mb=args.result_cache_mb,
+                   frame_memory=int(args.inflight_memory_mb * 1024 * 1024 / max(1, args.workers)))
+    try:
+        spec = spec_from_options(options)
+    except ValueError as e:
+        print(f"水印参数无效：{e}")
+        return 2
+    
+    input_root = os.path.abspath(args.input)
+    output_root = os.path.abspath(args.output)
+    if not os.path.isdir(input_root):
+        print(f"输入目录不存在：{input_root}")
+        return 1
+    os.makedirs(output_root, exist_ok=True)
+    # 上次异常退出时残留的暂存目录
+    for entry in os.scandir(output_root):
+        if entry.name.startswith(".staging-") and entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+    
+    manifest = WatchManifest(args.manifest or os.path.join(output_root, ".watermark-manifest.sqlite3"))
+    settings = _watch_settings(spec, options)
+    watcher = DirectoryWatcher(input_root, not args.no_recursive, args.poll_interval, args.rescan_interval,
+                               use_inotify=not args.no_inotify, exclude=(output_root,))
+    print(f"监视 {input_root}（{watcher.mode}），输出目录 {output_root}，{args.workers} 个工作进程")
+    
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+    os.environ.setdefault("WATERMARK_COMPOSITE_THREADS", str(max(1, (os.cpu_count() or 1) // max(1, args.workers))))
+    
+    pending = {}
+    in_flight = set()
+    # 尚未稳定（仍在写入）或正在处理中又发生变化的文件，下一轮重新检查
+    deferred = set()
+    done = failed = skipped = 0
+    
+    def submit(executor, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        relative = os.path.relpath(path, input_root)
+        if time.time() - stat.st_mtime < args.settle or relative in in_flight:
+            deferred.add(path)
+            return
+        row = manifest.get(relative)
+        if row and (row["size"], row["mtime_ns"], row["settings"]) == (stat.st_size, stat.st_mtime_ns, settings):
+            return
+        previous_digest = None
+        if row and row["status"] == "done" and row["settings"] == settings and row["output"] \
+                and os.path.exists(row["output"]):
+            previous_digest = row["digest"]
+        job = (path, relative, output_root, options, spec, previous_digest)
+        pending[executor.submit(_watch_worker, job)] = (relative, stat.st_size, stat.st_mtime_ns, row)
+        in_flight.add(relative)
+    
+    def finish(future):
+        nonlocal done, failed, skipped
+        relative, size, mtime_ns, row = pending.pop(future)
+        in_flight.discard(relative)
+        digest, target, error, observations = future.result()
+        metrics.observe_many(observations)
+        if error:
+            failed += 1
+            manifest.record(relative, size, mtime_ns, None, settings, "failed", error=error)
+            print(f"处理失败 {relative}: {error}")
+        elif target is None:
+            skipped += 1
+            manifest.record(relative, size, mtime_ns, digest, settings, "done", row["output"])
+        else:
+            done += 1
+            manifest.record(relative, size, mtime_ns, digest, settings, "done", target)
+            if args.verbose:
+                print(f"完成 {relative} -> {target}")
+    
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_watch_worker,
+                                 initargs=(args.log_level,)) as executor:
+            notify_ready(f"监视 {input_root}")
+            while not stop.is_set():
+                candidates = watcher.changes(timeout=0.5) | deferred
+                deferred.clear()
+                for path in sorted(candidates):
+                    submit(executor, path)
+                for future in [future for future in pending if future.done()]:
+                    finish(future)
+                if args.once and not pending and not deferred:
+                    break
+            for future in as_completed(list(pending)):
+                finish(future)
+    finally:
+        watcher.close()
+        manifest.close()
+    print(f"已停止：处理 {done} 个，内容未变跳过 {skipped} 个，失败 {failed} 个")
+    return 0 if failed == 0 else 1
+
+
+# ---------------------------------------------------------------------------
+# Web 请求的进程池（CPU 密集的水印处理不占用 Gradio 进程的 GIL）
+# ---------------------------------------------------------------------------
+
+def process_watermark_job(*args):
+    """
+    在工作进程中执行 process_watermark，返回 (结果, 本次任务的阶段耗时)
+    """
+    with metrics.capture() as observations:
+        result = run_profiled("process_watermark", process_watermark, *args)
+    return result, observations
+
+
+def _worker_pid(delay: float = 0.0) -> int:
+    # 占用工作进程一小段时间，使同一轮的其他任务分配到其他进程
+    time.sleep(delay)
+    return os.getpid()
+
+
+class PoolBusyError(RuntimeError):
+    """排队任务数已达上限"""
+
+
+class JobTimeoutError(RuntimeError):
+    """任务超过了单任务超时时间"""
+
+
+class ProcessingPool:
+    """
+    带显式排队上限和单任务超时的进程池
+
+    同时运行的任务数不超过 workers，其余任务按先来后到排队，最多 queue_depth 个；
+    run() 是生成器，排队期间产出 ('queued', 排队位置)，完成后产出 ('done', 结果)。
+    超时的任务会被放弃（结果丢弃），但已在工作进程中执行的部分无法中断，
+    它占用的名额在工作进程实际完成后才释放，后续任务在此之前保持排队。
+    """
+    def __init__(self, workers: int, queue_depth: int = 64, timeout: Optional[float] = 120,
+                 log_level: str = "WARNING"):
+        self.workers = max(1, workers)
+        self.log_level = log_level
+        self.queue_depth = max(0, queue_depth)
+        self.timeout = timeout if timeout and timeout > 0 else None
+        self._executor = None
+        self._waiting = []
+        self._running = 0
+        self._cond = threading.Condition()
+    
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn 避免在带线程的 Web 进程中 fork
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker, initargs=(self.log_level,)
+            )
+        return self._executor
+    
+    def start(self, timeout: Optional[float] = 120) -> int:
+        """
+        预先启动工作进程并等待其完成初始化（预加载、预热），返回已就绪的进程数
+
+        每轮同时提交与进程数相同的短任务，直到每个进程都执行过一次（即已完成初始化）。
         """
-        if not text.strip():
-            return image
-            
-        # 转换为 PIL Image 进行文字处理
-        pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        
-        # 创建透明图层
-        overlay = Image.new('RGBA', pil_image.size, (0, 0, 0, 0))
-        draw = ImageDraw.Draw(overlay)
+        deadline = time.monotonic() + (timeout or 120)
+        ready = set()
+        while len(ready) < self.workers and time.monotonic() < deadline:
+            futures = [self._get_executor().submit(_worker_pid, 0.2) for _ in range(self.workers)]
+            ready.update(future.result(timeout=max(0.0, deadline - time.monotonic())) for future in futures)
+        return len(ready)
+    
+    def stats(self) -> dict:
+        with self._cond:
+            return {"workers": self.workers, "running": self._running, "waiting": len(self._waiting)}
+    
+    def run(self, fn, *args):
+        token = object()
+        with self._cond:
+            if len(self._waiting) >= self.queue_depth and self._running >= self.workers:
+                raise PoolBusyError("服务繁忙，请稍后再试")
+            self._waiting.append(token)
         
-        # 尝试使用系统字体，如果失败则使用默认字体
         try:
-            # 在不同系统上尝试不同的字体路径，优先选择支持中文的字体
-            font_paths = [
-                # macOS 中文字体
-                "/System/Library/Fonts/PingFang.ttc",
-                "/System/Library/Fonts/STHeiti Light.ttc",
-                "/System/Library/Fonts/Hiragino Sans GB.ttc",
-                "/Library/Fonts/Arial Unicode MS.ttf",
-                # Linux 中文字体
-                "/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf",
-                "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
-                "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
-                # Windows 中文字体
-                "C:/Windows/Fonts/msyh.ttc",  # 微软雅黑
-                "C:/Windows/Fonts/simhei.ttf",  # 黑体
-                "C:/Windows/Fonts/simsun.ttc",  # 宋体
-                # 英文字体备选
-                "/System/Library/Fonts/Arial.ttf",  # macOS
-                "/System/Library/Fonts/Helvetica.ttc",  # macOS
-                "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # Linux
-                "arial.ttf",  # Windows
-                "C:/Windows/Fonts/arial.ttf"  # Windows 绝对路径
-            ]
-            
-            font = None
-            for font_path in font_paths:
-                if os.path.exists(font_path):
-                    try:
-                        font = ImageFont.truetype(font_path, font_size)
-                        print(f"使用字体：{font_path}")
+            last_position = None
+            while True:
+                with self._cond:
+                    if self._waiting[0] is token and self._running < self.workers:
+                        self._waiting.pop(0)
+                        self._running += 1
                         break
-                    except Exception as e:
-                        print(f"字体加载失败 {font_path}: {e}")
-                        continue
-            
-            if font is None:
-                font = ImageFont.load_default()
-                print("使用默认字体")
-        except Exception as e:
-            font = ImageFont.load_default()
-            print(f"字体加载异常：{e}, 使用默认字体")
-        
-        # 获取文字尺寸
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        
-        # 计算透明度值 (确保有足够的可见度)
-        alpha = max(50, int(255 * opacity))  # 最小透明度为 50，确保可见
-        
-        print(f"添加水印：文字='{text}', 颜色={color}, 透明度={alpha}, 重复模式={repeat_mode}")
-        
-        if repeat_mode:
-            # 重复水印模式 - 在整个背景添加
-            image_width, image_height = pil_image.size
-            
-            # 确保间距合理
-            effective_spacing_x = max(spacing_x, text_width + 20)
-            effective_spacing_y = max(spacing_y, text_height + 20)
-            
-            # 计算需要的行列数 (覆盖整个图像)
-            cols = (image_width // effective_spacing_x) + 2
-            rows = (image_height // effective_spacing_y) + 2
-            
-            print(f"重复水印：图像尺寸={image_width}x{image_height}, 行列数={rows}x{cols}, 间距={effective_spacing_x}x{effective_spacing_y}")
-            
-            watermark_count = 0
-            for row in range(rows):
-                for col in range(cols):
-                    # 计算每个水印的位置
-                    x = col * effective_spacing_x
-                    y = row * effective_spacing_y
-                    
-                    # 错位排列，让水印更自然
-                    if row % 2 == 1:
-                        x += effective_spacing_x // 2
-                    
-                    # 确保水印在图像范围内或部分可见
-                    if x < image_width + text_width and y < image_height + text_height and x > -text_width and y > -text_height:
-                        if angle != 0:
-                            # 为旋转文字创建临时图像
-                            temp_size = max(text_width, text_height) + 100
-                            temp_img = Image.new('RGBA', (temp_size, temp_size), (0, 0, 0, 0))
-                            temp_draw = ImageDraw.Draw(temp_img)
-                            temp_draw.text((temp_size//2 - text_width//2, temp_size//2 - text_height//2), 
-                                         text, font=font, fill=(*color, alpha))
-                            
-                            # 旋转
-                            rotated = temp_img.rotate(angle, expand=True)
-                            
-                            # 计算粘贴位置
-                            paste_x = x - rotated.width // 2
-                            paste_y = y - rotated.height // 2
-                            
-                            overlay.paste(rotated, (paste_x, paste_y), rotated)
-                        else:
-                            # 直接绘制文字
-                            draw.text((x, y), text, font=font, fill=(*color, alpha))
-                        
-                        watermark_count += 1
-            
-            print(f"实际添加了 {watermark_count} 个水印")
-        else:
-            # 单个水印模式
-            if angle != 0:
-                # 创建临时图像用于旋转
-                temp_size = max(text_width, text_height) + 100
-                temp_img = Image.new('RGBA', (temp_size, temp_size), (0, 0, 0, 0))
-                temp_draw = ImageDraw.Draw(temp_img)
-                temp_draw.text((50, 50), text, font=font, fill=(*color, alpha))
-                
-                # 旋转
-                rotated = temp_img.rotate(angle, expand=True)
-                
-                # 计算粘贴位置
-                paste_x = max(0, min(position[0], pil_image.width - rotated.width))
-                paste_y = max(0, min(position[1], pil_image.height - rotated.height))
-                
-                overlay.paste(rotated, (paste_x, paste_y), rotated)
-            else:
-                # 直接绘制文字
-                draw.text(position, text, font=font, fill=(*color, alpha))
+                    position = self._waiting.index(token) + 1
+                if position != last_position:
+                    last_position = position
+                    yield 'queued', position
+                with self._cond:
+                    self._cond.wait(timeout=0.5)
+        except BaseException:
+            # 客户端断开等情况下退出排队
+            with self._cond:
+                if token in self._waiting:
+                    self._waiting.remove(token)
+                self._cond.notify_all()
+            raise
         
-        # 合并图层
-        watermarked = Image.alpha_composite(pil_image.convert('RGBA'), overlay)
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # 任务真正结束（包括超时后仍在运行的任务）时才释放名额
+        future.add_done_callback(self._release)
+        try:
+            result = future.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            future.cancel()
+            raise JobTimeoutError(f"处理超时（超过 {self.timeout:g} 秒）")
         
-        # 转换回 OpenCV 格式
-        result = cv2.cvtColor(np.array(watermarked.convert('RGB')), cv2.COLOR_RGB2BGR)
-        return result
+        yield 'done', result
     
-    def add_image_watermark(self, 
-                           image: np.ndarray, 
-                           watermark_image: np.ndarray, 
-                           position: Tuple[int, int], 
-                           scale: float = 0.2, 
-                           opacity: float = 0.7, 
-                           angle: float = 0) -> np.ndarray:
+    def _release(self, future=None) -> None:
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+    
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+# ---------------------------------------------------------------------------
+# 结果交付（每个请求独立的临时文件，按 TTL 清理）
+# ---------------------------------------------------------------------------
+
+class ResultStore:
+    """
+    为每个请求生成独立的结果文件，避免并发用户互相覆盖下载内容
+
+    文件位于进程专属的临时目录中，超过 TTL（环境变量 WATERMARK_RESULT_TTL，
+    默认 3600 秒）的结果会在后续保存时被清理，进程退出时整个目录被删除。
+    """
+    def __init__(self, root: Optional[str] = None, ttl: Optional[float] = None,
+                 sweep_interval: float = 60):
+        self.root = root or tempfile.mkdtemp(prefix="watermark_results_")
+        self.ttl = ttl if ttl is not None else env_number("WATERMARK_RESULT_TTL", 3600.0, float, minimum=0)
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        atexit.register(shutil.rmtree, self.root, True)
+    
+    def save(self, image, filename: str = "watermarked_image.png", quality: int = DEFAULT_QUALITY,
+             png_compression: int = DEFAULT_PNG_COMPRESSION) -> str:
         """
-        添加图片水印
+        编码结果并写入唯一目录，返回文件路径（下载时文件名保持不变，格式由扩展名决定）
         """
-        h, w = image.shape[:2]
-        
-        # 调整水印大小
-        wm_h, wm_w = watermark_image.shape[:2]
-        new_width = int(w * scale)
-        new_height = int(wm_h * new_width / wm_w)
-        
-        watermark_resized = cv2.resize(watermark_image, (new_width, new_height))
-        
-        # 如果需要旋转
-        if angle != 0:
-            center = (new_width // 2, new_height // 2)
-            rotation_matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
-            watermark_resized = cv2.warpAffine(watermark_resized, rotation_matrix, (new_width, new_height))
-        
-        # 确保位置在图像范围内
-        y1 = max(0, min(position[1], h - new_height))
-        y2 = y1 + new_height
-        x1 = max(0, min(position[0], w - new_width))
-        x2 = x1 + new_width
-        
-        # 调整水印区域大小以适应图像边界
-        if y2 > h:
-            y2 = h
-            new_height = y2 - y1
-            watermark_resized = watermark_resized[:new_height, :]
-        
-        if x2 > w:
-            x2 = w
-            new_width = x2 - x1
-            watermark_resized = watermark_resized[:, :new_width]
-        
-        # 应用透明度
-        roi = image[y1:y2, x1:x2]
-        
-        # 确保尺寸匹配
-        if roi.shape[:2] != watermark_resized.shape[:2]:
-            watermark_resized = cv2.resize(watermark_resized, (roi.shape[1], roi.shape[0]))
-        
-        # 混合图像
-        result_roi = cv2.addWeighted(roi, 1 - opacity, watermark_resized, opacity, 0)
-        
-        # 创建结果图像
-        result = image.copy()
-        result[y1:y2, x1:x2] = result_roi
+        return self.save_bytes(encode_image(image, resolve_output_format(path=filename), quality, png_compression),
+                               filename)
+    
+    def save_bytes(self, data: bytes, filename: str) -> str:
+        """
+        将已编码的结果写入唯一目录，返回文件路径
+        """
+        path = self.new_path(filename)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+    
+    def new_path(self, filename: str) -> str:
+        """
+        创建唯一目录并返回其中的结果文件路径（文件由调用方写入，如从结果缓存复制）
+        """
+        self.sweep()
+        directory = os.path.join(self.root, uuid.uuid4().hex)
+        os.makedirs(directory)
+        return os.path.join(directory, filename)
+    
+    def sweep(self, force: bool = False) -> int:
+        """
+        删除过期的结果目录，返回删除的数量
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_sweep < self.sweep_interval:
+                return 0
+            self._last_sweep = now
         
-        return result
+        removed = 0
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            try:
+                if now - entry.stat().st_mtime > self.ttl:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+        return removed
 
-# 全局处理器实例
-processor = WatermarkProcessor()
 
-def process_watermark(image, watermark_type, text_content, text_font_size, text_color, 
-                     watermark_image, position_x, position_y, opacity, angle, scale, 
-                     repeat_mode, spacing_x, spacing_y):
+# Web 界面的结果存储，首次使用时创建临时目录
+_result_store = None
+
+
+def get_result_store() -> ResultStore:
+    global _result_store
+    if _result_store is None:
+        _result_store = ResultStore()
+    return _result_store
+
+
+# ---------------------------------------------------------------------------
+# 输入准入控制（只读取文件头，按像素和内存预算拒绝或缩小超大图片）
+# ---------------------------------------------------------------------------
+
+# 超过像素上限时的处理方式
+OVERSIZE_POLICIES = ("downscale", "reject")
+
+
+class ImageProbe(NamedTuple):
+    """从文件头读取的图像信息（不解码像素）"""
+    width: int
+    height: int
+    mode: str
+    format: Optional[str]
+    
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+
+class InputTooLargeError(ValueError):
+    """输入图片超过像素上限且策略为拒绝"""
+
+
+def probe_image(source) -> ImageProbe:
     """
-    处理水印添加的主函数
+    读取图像的尺寸、模式和格式，只解析文件头
+
+    source 可以是文件路径或尚未解码的 PIL 图像（Image.open 的结果本身就只读取了文件头）。
     """
-    if image is None:
-        return None, "请先上传图片"
+    if isinstance(source, str):
+        with Image.open(source) as image:
+            return ImageProbe(image.width, image.height, image.mode, image.format)
+    return ImageProbe(source.width, source.height, source.mode, getattr(source, "format", None))
+
+
+def upload_source(image):
+    """
+    返回上传图片的原始文件路径，没有文件（如剪贴板粘贴、已转换的 TIFF）时返回图像本身
+
+    传路径给工作进程不需要在 Web 进程中解码和序列化像素，工作进程可以缩小解码。
+    """
+    path = getattr(image, "filename", None)
+    if isinstance(path, str) and path and os.path.isfile(path):
+        return path
+    return image
+
+
+class AdmissionControl:
+    """
+    Web 请求的准入控制
+
+    - 像素数超过 max_pixels 的图片按 policy 处理：downscale 在解码时按比例缩小到上限以内
+      （JPEG 直接缩小解码），reject 直接拒绝；
+    - 同时处理中的请求按估算内存占用预留额度，总量不超过 memory_bytes，
+      额度不足时排队等待，等待超过 timeout 秒提示服务繁忙。
+    """
+    # 每个像素的额外内存估算（字节）：RGB 工作缓冲区、全图覆盖层、编码缓冲区和返回结果
+    WORKING_BYTES_PER_PIXEL = 16
     
-    try:
-        # 首先转换图像格式以确保兼容性
-        converted_image = processor.load_and_convert_image(image)
-        
-        # 转换 PIL 图像为 OpenCV 格式
-        if isinstance(converted_image, Image.Image):
-            opencv_image = cv2.cvtColor(np.array(converted_image), cv2.COLOR_RGB2BGR)
-        else:
-            opencv_image = converted_image
-        
-        # 获取图像尺寸用于限制位置参数
-        height, width = opencv_image.shape[:2]
-        
-        # 限制位置参数在合理范围内
-        position_x = max(0, min(int(position_x), width - 1))
-        position_y = max(0, min(int(position_y), height - 1))
-        position = (position_x, position_y)
-        
-        # 限制字体大小在合理范围内
-        text_font_size = max(1, min(int(text_font_size), 500))
-        
-        # 限制透明度在有效范围内
-        opacity = max(0.0, min(float(opacity), 1.0))
-        
-        # 限制角度在有效范围内
-        angle = max(-180, min(float(angle), 180))
-        
-        # 限制缩放比例在有效范围内
-        scale = max(0.01, min(float(scale), 2.0))
-        
-        # 限制间距参数
-        spacing_x = max(50, min(int(spacing_x), 500))
-        spacing_y = max(50, min(int(spacing_y), 300))
-        
-        if watermark_type == "文字水印":
-            if not text_content.strip():
-                return converted_image, "请输入水印文字"
-            
-            # 转换颜色格式 - 增强错误处理
-            try:
-                print(f"原始颜色值：{text_color}")
-                
-                if isinstance(text_color, str) and text_color.startswith('#'):
-                    # 处理 #FFFFFF 格式
-                    hex_color = text_color.lstrip('#')
-                    if len(hex_color) == 6:
-                        color_rgb = tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
-                    elif len(hex_color) == 3:
-                        # 处理 #FFF 格式
-                        color_rgb = tuple(int(hex_color[i]*2, 16) for i in range(3))
-                    else:
-                        raise ValueError("Invalid hex color format")
-                elif isinstance(text_color, str) and text_color.startswith('rgb'):
-                    # 处理 rgb(255,255,255) 格式
-                    import re
-                    rgb_values = re.findall(r'\d+', text_color)
-                    if len(rgb_values) >= 3:
-                        color_rgb = tuple(int(rgb_values[i]) for i in range(3))
-                    else:
-                        raise ValueError("Invalid rgb color format")
-                elif isinstance(text_color, (list, tuple)) and len(text_color) >= 3:
-                    # 处理已经是 RGB 元组的情况
-                    color_rgb = tuple(int(c) for c in text_color[:3])
-                else:
-                    # 尝试直接解析为 hex（去掉#）
-                    if isinstance(text_color, str):
-                        clean_color = text_color.lstrip('#')
-                        if len(clean_color) == 6:
-                            color_rgb = tuple(int(clean_color[i:i+2], 16) for i in (0, 2, 4))
-                        else:
-                            raise ValueError("Unknown color format")
-                    else:
-                        raise ValueError("Unknown color format")
-                
-                # 确保颜色值在有效范围内
-                color_rgb = tuple(max(0, min(255, int(c))) for c in color_rgb)
-                print(f"解析后颜色值：{color_rgb}")
-                
-            except (ValueError, IndexError, TypeError) as e:
-                print(f"颜色解析错误：{e}, 原始值：{text_color}, 使用默认灰色")
-                color_rgb = (128, 128, 128)  # 使用灰色作为默认
-            
-            result = processor.add_text_watermark(
-                opencv_image, text_content, position, 
-                text_font_size, color_rgb, opacity, angle,
-                repeat_mode, spacing_x, spacing_y
-            )
-        
-        elif watermark_type == "图片水印":
-            if watermark_image is None:
-                return converted_image, "请上传水印图片"
-            
-            # 转换水印图片格式并转为 OpenCV 格式
-            converted_watermark = processor.load_and_convert_image(watermark_image)
-            if isinstance(converted_watermark, Image.Image):
-                watermark_cv = cv2.cvtColor(np.array(converted_watermark), cv2.COLOR_RGB2BGR)
-            else:
-                watermark_cv = converted_watermark
-            
-            result = processor.add_image_watermark(
-                opencv_image, watermark_cv, position, 
-                scale, opacity, angle
+    def __init__(self, max_pixels: int, policy: str = "downscale", memory_bytes: int = 0,
+                 timeout: Optional[float] = 120):
+        if policy not in OVERSIZE_POLICIES:
+            raise ValueError(f"不支持的超大图片处理方式：{policy}")
+        self.max_pixels = max(0, int(max_pixels))
+        self.policy = policy
+        self.memory_bytes = max(0, int(memory_bytes))
+        self.timeout = timeout if timeout and timeout > 0 else None
+        self._reserved = 0
+        self._admitted = 0
+        self._downscaled = 0
+        self._rejected = 0
+        self._cond = threading.Condition()
+    
+    @classmethod
+    def from_env(cls, timeout: Optional[float] = 120) -> 'AdmissionControl':
+        """
+        由环境变量 WATERMARK_MAX_MEGAPIXELS、WATERMARK_OVERSIZE_POLICY 和
+        WATERMARK_INFLIGHT_MEMORY_MB 创建，0 表示不限制
+        """
+        return cls(
+            env_number("WATERMARK_MAX_MEGAPIXELS", 100.0, float, minimum=0) * 1_000_000,
+            os.environ.get("WATERMARK_OVERSIZE_POLICY", "downscale"),
+            env_number("WATERMARK_INFLIGHT_MEMORY_MB", 4096.0, float, minimum=0) * 1024 * 1024,
+            timeout
+        )
+    
+    @classmethod
+    def estimate_bytes(cls, probe: ImageProbe, target: Optional[Tuple[int, int]] = None) -> int:
+        """
+        估算处理一张图片的峰值内存：解码后的原图加上按处理尺寸计算的工作缓冲区
+
+        缩小处理时 JPEG 按 1/2、1/4、1/8 缩小解码（每边至多为目标的 2 倍），其他格式仍完整解码。
+        """
+        try:
+            bands = Image.getmodebands(probe.mode)
+        except (KeyError, ValueError):
+            bands = 4
+        working = probe.pixels if target is None else target[0] * target[1]
+        decoded = probe.pixels
+        if target is not None and probe.format in ('JPEG', 'MPO'):
+            decoded = min(decoded, 4 * working)
+        return decoded * bands + working * cls.WORKING_BYTES_PER_PIXEL
+    
+    def target_size(self, probe: ImageProbe) -> Optional[Tuple[int, int]]:
+        """
+        检查图片尺寸，返回需要缩小到的尺寸（宽, 高），不需要缩小时返回 None
+
+        超过像素上限且策略为 reject 时抛出 InputTooLargeError。
+        """
+        if not self.max_pixels or probe.pixels <= self.max_pixels:
+            return None
+        if self.policy == "reject":
+            raise InputTooLargeError(
+                f"图片过大：{probe.width}x{probe.height}（{probe.pixels / 1e6:.1f} MP），"
+                f"上限为 {self.max_pixels / 1e6:g} MP"
             )
-        
-        else:
-            return converted_image, "请选择水印类型"
-        
-        # 转换回 PIL 格式用于显示
-        result_pil = Image.fromarray(cv2.cvtColor(result, cv2.COLOR_BGR2RGB))
-        return result_pil, "水印添加成功！"
-        
-    except Exception as e:
-        # 如果处理失败，返回转换后的原图
+        ratio = (self.max_pixels / probe.pixels) ** 0.5
+        size = (probe.width, probe.height)
+        target = fit_size(size, (max(1, int(probe.width * ratio)), max(1, int(probe.height * ratio))))
+        # 取 fit_size 的不动点：解码时按该尺寸再次计算 fit_size 得到的正是它，报告的尺寸即实际输出尺寸
+        while fit_size(size, target) != target:
+            target = fit_size(size, target)
+        return target
+    
+    def admit(self, source) -> Tuple[ImageProbe, Optional[Tuple[int, int]]]:
+        """
+        读取文件头并检查尺寸，返回 (图像信息, 缩小后的尺寸或 None)，并记录准入统计
+        """
+        probe = probe_image(source)
         try:
-            converted_image = processor.load_and_convert_image(image)
-            return converted_image, f"处理失败：{str(e)}"
-        except:
-            return image, f"处理失败：{str(e)}"
+            target = self.target_size(probe)
+        except InputTooLargeError:
+            with self._cond:
+                self._rejected += 1
+            raise
+        with self._cond:
+            self._admitted += 1
+            if target is not None:
+                self._downscaled += 1
+        if target is not None:
+            logger.info("超大图片 %dx%d 将缩小到 %dx%d 处理", probe.width, probe.height, *target)
+        return probe, target
+    
+    def try_reserve(self, nbytes: int) -> bool:
+        """
+        尝试立即预留内存额度，成功返回 True
+        """
+        return self._reserve(nbytes, blocking=False)
+    
+    def reserve(self, nbytes: int) -> None:
+        """
+        预留内存额度，额度不足时等待其他请求完成；等待超时抛出 PoolBusyError
+
+        单个请求的估算超过总额度时按总额度预留（即独占运行），不会永远等待。
+        """
+        if not self._reserve(nbytes, blocking=True):
+            raise PoolBusyError("服务繁忙：处理中的图片占用内存已达上限，请稍后再试")
+    
+    def _reserve(self, nbytes: int, blocking: bool) -> bool:
+        if not self.memory_bytes:
+            return True
+        nbytes = min(nbytes, self.memory_bytes)
+        with self._cond:
+            if not blocking:
+                if self._reserved + nbytes > self.memory_bytes:
+                    return False
+            elif not self._cond.wait_for(lambda: self._reserved + nbytes <= self.memory_bytes,
+                                         timeout=self.timeout):
+                return False
+            self._reserved += nbytes
+            return True
+    
+    def release(self, nbytes: int) -> None:
+        if not self.memory_bytes:
+            return
+        with self._cond:
+            self._reserved = max(0, self._reserved - min(nbytes, self.memory_bytes))
+            self._cond.notify_all()
+    
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "admitted": self._admitted, "downscaled": self._downscaled, "rejected": self._rejected,
+                "reserved_bytes": self._reserved, "memory_bytes": self.memory_bytes,
+            }
+
 
-def create_gradio_interface():
+def create_gradio_interface(pool: Optional[ProcessingPool] = None,
+                            admission: Optional[AdmissionControl] = None):
     """
     创建 Gradio 界面
+
+    传入 pool 时水印处理在进程池中执行，否则在 Gradio 的工作线程中直接处理。
+    admission 为输入准入控制，默认由环境变量创建。
     """
+    # 仅在启动 Web 界面时导入 Gradio，批处理等无界面模式不依赖它
+    import gradio as gr
+    
+    result_store = get_result_store()
+    result_cache = get_result_cache()
+    if admission is None:
+        admission = AdmissionControl.from_env(pool.timeout if pool is not None else 120)
+    
     # 自定义CSS样式
     custom_css = """
     .main-header {
@@ -547,9 +3691,12 @@ def create_gradio_interface():
                 
                 with gr.Group():
                     gr.Markdown("### 📁 图片上传")
+                    # image_mode=None：不做模式转换，事件处理函数收到的是只读取了文件头的图像，
+                    # 由准入控制检查尺寸后再决定如何解码
                     input_image = gr.Image(
                         label="选择图片文件", 
                         type="pil",
+                        image_mode=None,
                         sources=["upload", "clipboard"],
                         height=350,  # 增加高度
                         elem_classes=["image-upload-container"]
@@ -632,8 +3779,25 @@ def create_gradio_interface():
                         gr.Button("⚪", size="sm").click(lambda: "#F1F2F6", outputs=[text_color])
                         gr.Button("🟡", size="sm").click(lambda: "#FFA502", outputs=[text_color])
                         gr.Button("🟢", size="sm").click(lambda: "#2ED573", outputs=[text_color])
-                    
-                    # 重复模式设置
+                
+                # 图片水印设置
+                with gr.Group(visible=False) as image_group:
+                    gr.Markdown("### 🖼️ 图片水印配置")
+                    # image_mode=None：保留 PNG/GIF 等水印图片的透明通道，默认的 RGB 转换会丢弃它
+                    watermark_image = gr.Image(
+                        label="水印图片", 
+                        type="pil",
+                        image_mode=None,
+                        sources=["upload"],
+                        height=200
+                    )
+                    scale = gr.Slider(
+                        minimum=0.05, maximum=1.0, value=0.2, 
+                        label="水印大小比例", step=0.05
+                    )
+                
+                # 重复模式设置（文字和图片水印通用）
+                with gr.Group():
                     repeat_mode = gr.Checkbox(
                         label="🔄 重复水印模式（全图覆盖）",
                         value=True,
@@ -650,20 +3814,6 @@ def create_gradio_interface():
                             label="垂直间距", step=10
                         )
                 
-                # 图片水印设置
-                with gr.Group(visible=False) as image_group:
-                    gr.Markdown("### 🖼️ 图片水印配置")
-                    watermark_image = gr.Image(
-                        label="水印图片", 
-                        type="pil",
-                        sources=["upload"],
-                        height=200
-                    )
-                    scale = gr.Slider(
-                        minimum=0.05, maximum=1.0, value=0.2, 
-                        label="水印大小比例", step=0.05
-                    )
-                
                 # 通用参数设置
                 with gr.Group():
                     gr.Markdown("### 🎛️ 高级设置")
@@ -689,7 +3839,26 @@ def create_gradio_interface():
                             label="旋转角度 (°)",
                             info="负值为逆时针"
                         )
-                
+
+                # 输出设置
+                with gr.Group():
+                    gr.Markdown("### 💾 输出设置")
+                    output_format = gr.Dropdown(
+                        choices=[("与输入相同", "auto"), ("PNG", "png"), ("JPEG", "jpeg"), ("WebP", "webp")],
+                        value=os.environ.get("WATERMARK_OUTPUT_FORMAT", "auto"),
+                        label="输出格式"
+                    )
+                    with gr.Row():
+                        output_quality = gr.Slider(
+                            minimum=1, maximum=100, value=DEFAULT_QUALITY, step=1,
+                            label="JPEG/WebP 质量"
+                        )
+                        png_compression = gr.Slider(
+                            minimum=0, maximum=9, value=DEFAULT_PNG_COMPRESSION, step=1,
+                            label="PNG 压缩级别",
+                            info="越小编码越快、文件越大"
+                        )
+
                 # 处理按钮
                 with gr.Row():
                     process_btn = gr.Button(
@@ -769,10 +3938,14 @@ def create_gradio_interface():
             
             try:
                 image = Image.open(file.name)
-                converted_image = processor.load_and_convert_image(image)
+                target_size = admission.target_size(probe_image(image))
+                converted_image = processor.load_and_convert_image(image, target_size)
                 return converted_image
+            except InputTooLargeError as e:
+                logger.warning("%s", e)
+                return None
             except Exception as e:
-                print(f"TIFF 文件处理错误：{e}")
+                logger.warning("TIFF 文件处理错误：%s", e)
                 return None
         
         def toggle_watermark_settings(watermark_type):
@@ -781,45 +3954,109 @@ def create_gradio_interface():
             else:
                 return gr.update(visible=False), gr.update(visible=True)
         
-        def update_download(result_image):
-            if result_image is not None:
-                temp_path = "watermarked_image.png"
-                result_image.save(temp_path)
-                return gr.update(value=temp_path, visible=True)
-            return gr.update(visible=False)
+        def process_and_deliver(*inputs):
+            # 处理完成后直接编码一次结果文件交给下载按钮，不再从预览图回读
+            *inputs, output_format, quality, png_compression = inputs
+            output_format = resolve_output_format(output_format, getattr(inputs[0], "format", None))
+            filename = "watermarked_image" + OUTPUT_FORMATS[output_format]
+            probe, target_size = None, None
+            if inputs[0] is not None:
+                # 只读取文件头检查尺寸；把原始文件路径交给处理函数，像素只在处理时解码一次
+                inputs[0] = upload_source(inputs[0])
+                try:
+                    probe, target_size = admission.admit(inputs[0])
+                except InputTooLargeError as e:
+                    yield gr.update(), str(e), gr.update(visible=False)
+                    return
+            cache_key = result_cache_key(result_cache, inputs, output_format, quality, png_compression,
+                                         target_size)
+            if cache_key:
+                # 相同图片和参数已处理过，直接返回缓存的编码结果
+                path = result_store.new_path(filename)
+                if result_cache.fetch(cache_key, path):
+                    yield path, "水印添加成功！（缓存结果）", gr.update(value=path, visible=True)
+                    return
+            
+            # 按估算的内存占用预留额度，同时处理中的图片总内存不超过上限
+            reserved = AdmissionControl.estimate_bytes(probe, target_size) if probe is not None else 0
+            if not admission.try_reserve(reserved):
+                yield gr.update(), "服务繁忙：等待处理中的图片释放内存...", gr.update(visible=False)
+                try:
+                    admission.reserve(reserved)
+                except PoolBusyError as e:
+                    yield gr.update(), str(e), gr.update(visible=False)
+                    return
+            
+            try:
+                if pool is None:
+                    result_image, status = run_profiled("process_watermark", process_watermark, *inputs,
+                                                        target_size)
+                else:
+                    try:
+                        for state, value in pool.run(process_watermark_job, *inputs, target_size):
+                            if state == 'queued':
+                                yield gr.update(), f"服务繁忙，排队中：第 {value} 位", gr.update(visible=False)
+                            else:
+                                (result_image, status), observations = value
+                                metrics.observe_many(observations)
+                    except (PoolBusyError, JobTimeoutError) as e:
+                        yield gr.update(), str(e), gr.update(visible=False)
+                        return
+                
+                if result_image is not None and status == "水印添加成功！":
+                    if target_size is not None:
+                        status += (f"（原图 {probe.width}x{probe.height} 超过像素上限，"
+                                   f"已缩小到 {result_image.width}x{result_image.height}）")
+                    data = encode_image(result_image, output_format, quality, png_compression)
+                    path = result_store.save_bytes(data, filename)
+                    if cache_key:
+                        result_cache.put(cache_key, data)
+                    yield result_image, status, gr.update(value=path, visible=True)
+                else:
+                    yield result_image, status, gr.update(visible=False)
+            finally:
+                admission.release(reserved)
         
         def handle_image_upload(image):
             if image is None:
                 return None, gr.update(visible=False)
             
+            # 尺寸检查只读取文件头，超过像素上限时拒绝或提示将缩小处理
+            try:
+                target_size = admission.target_size(probe_image(image))
+            except InputTooLargeError as e:
+                return None, gr.update(value={"错误": str(e)}, visible=True)
+            
             try:
                 if hasattr(image, 'format') and image.format in ['TIFF', 'TIF']:
-                    print(f"检测到 TIFF 格式图像，正在转换...")
-                    converted_image = processor.load_and_convert_image(image)
+                    logger.debug("检测到 TIFF 格式图像，正在转换...")
+                    converted_image = processor.load_and_convert_image(image, target_size)
                     info = {
                         "格式": "TIFF (已转换)",
                         "尺寸": f"{image.size[0]} x {image.size[1]}",
                         "模式": image.mode
                     }
-                    return converted_image, gr.update(value=info, visible=True)
                 elif hasattr(image, 'mode') and image.mode in ['CMYK', 'L', 'P', '1']:
-                    converted_image = processor.load_and_convert_image(image)
+                    converted_image = processor.load_and_convert_image(image, target_size)
                     info = {
                         "格式": getattr(image, 'format', 'Unknown'),
                         "尺寸": f"{image.size[0]} x {image.size[1]}",
                         "模式": f"{image.mode} (已转换为RGB)"
                     }
-                    return converted_image, gr.update(value=info, visible=True)
                 else:
+                    # 浏览器可以直接显示的图片保持原始上传文件，不在此处解码和重新编码
+                    converted_image = gr.update()
                     info = {
                         "格式": getattr(image, 'format', 'Unknown'),
                         "尺寸": f"{image.size[0]} x {image.size[1]}",
                         "模式": image.mode
                     }
-                    return image, gr.update(value=info, visible=True)
+                if target_size is not None:
+                    info["处理尺寸"] = f"{target_size[0]} x {target_size[1]} (超过像素上限，按比例缩小)"
+                return converted_image, gr.update(value=info, visible=True)
                     
             except Exception as e:
-                print(f"图像上传处理错误：{e}")
+                logger.warning("图像上传处理错误：%s", e)
                 try:
                     if hasattr(image, 'convert'):
                         return image.convert('RGB'), gr.update(visible=False)
@@ -851,28 +4088,140 @@ def create_gradio_interface():
             outputs=[input_image, info_display]
         )
         
+        # 低分辨率实时预览：上传时生成代理图，参数变化时只在代理图上渲染
+        preview_state = gr.State(None)
+        preview_inputs = [
+            preview_state, watermark_type, text_content, text_font_size, text_color,
+            watermark_image, position_x, position_y, opacity, angle, scale,
+            repeat_mode, spacing_x, spacing_y
+        ]
+        
+        def prepare_preview(image):
+            # 超过像素上限且策略为拒绝的图片不生成预览（上传处理会清空它）
+            if image is not None:
+                try:
+                    admission.target_size(probe_image(image))
+                except InputTooLargeError:
+                    return None
+            return make_preview_proxy(image)
+        
+        def update_preview(*inputs):
+            # 图片或参数变化后，之前生成的原尺寸结果已与预览不一致，清空下载按钮
+            preview, status = process_preview(*inputs)
+            return preview, status, gr.update(value=None, visible=False)
+        
+        input_image.change(
+            fn=prepare_preview,
+            inputs=[input_image],
+            outputs=[preview_state],
+            show_progress="hidden"
+        ).then(
+            fn=update_preview,
+            inputs=preview_inputs,
+            outputs=[output_image, status_text, download_btn],
+            show_progress="hidden"
+        )
+        
+        for control in [watermark_type, text_content, text_font_size, text_color, watermark_image,
+                        position_x, position_y, opacity, angle, scale, repeat_mode, spacing_x, spacing_y]:
+            control.change(
+                fn=update_preview,
+                inputs=preview_inputs,
+                outputs=[output_image, status_text, download_btn],
+                show_progress="hidden",
+                trigger_mode="always_last"
+            )
+        
         process_btn.click(
-            fn=process_watermark,
+            fn=process_and_deliver,
             inputs=[
                 input_image, watermark_type, text_content, text_font_size, text_color,
                 watermark_image, position_x, position_y, opacity, angle, scale,
-                repeat_mode, spacing_x, spacing_y
+                repeat_mode, spacing_x, spacing_y, output_format, output_quality, png_compression
             ],
-            outputs=[output_image, status_text]
-        ).then(
-            fn=update_download,
-            inputs=[output_image],
-            outputs=[download_btn]
+            outputs=[output_image, status_text, download_btn],
+            concurrency_limit=(pool.workers + pool.queue_depth) if pool is not None else 1
         )
 
     return demo
 
+def main(argv=None) -> int:
+    args = build_arg_parser().parse_args(argv)
+    configure_logging(args.log_level)
+    if args.profile_dir:
+        # 通过环境变量传递给工作进程
+        os.environ["WATERMARK_PROFILE_DIR"] = args.profile_dir
+    if args.preload_logo:
+        preload = [os.environ.get("WATERMARK_PRELOAD_LOGOS", "")] + args.preload_logo
+        os.environ["WATERMARK_PRELOAD_LOGOS"] = os.pathsep.join(path for path in preload if path)
+    if args.composite_threads:
+        os.environ["WATERMARK_COMPOSITE_THREADS"] = str(args.composite_threads)
+    if args.result_cache:
+        os.environ["WATERMARK_RESULT_CACHE_DIR"] = args.result_cache
+        os.environ["WATERMARK_RESULT_CACHE_MB"] = str(args.result_cache_mb)
+    
+    if args.command in ("batch", "stream", "video", "watch"):
+        if args.type == "image" and not args.logo:
+            print("图片水印需要通过 --logo 指定水印图片")
+            return 2
+        if args.command == "stream":
+            return run_stream(args)
+        if args.command == "video":
+            return run_video(args)
+        if args.command == "watch":
+            return run_watch(args)
+        return run_batch(args)
+    
+    # 创建并启动应用（预览在 Web 进程内渲染，同样需要预加载水印图片和预热）
+    started = time.perf_counter()
+    init_worker(args.log_level)
+    pool = None
+    pool_starter = None
+    if args.workers > 0:
+        # 与批处理相同，按工作进程数平分条带并行的线程，避免 workers × CPU 核数个线程争抢（工作进程继承环境变量）
+        os.environ.setdefault("WATERMARK_COMPOSITE_THREADS", str(max(1, (os.cpu_count() or 1) // args.workers)))
+        pool = ProcessingPool(args.workers, args.queue_depth, args.job_timeout, args.log_level)
+        # 工作进程的启动和预热与 Gradio 的导入、界面构建同时进行
+        pool_starter = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pool-start").submit(pool.start)
+    
+    admission = AdmissionControl(args.max_megapixels * 1_000_000, args.oversize,
+                                 args.inflight_memory_mb * 1024 * 1024, args.job_timeout)
+    
+    if args.metrics_port:
+        def gauges():
+            values = {f"watermark_overlay_cache_{k}": v for k, v in processor.overlay_cache.stats().items()}
+            values.update({f"watermark_logo_cache_{k}": v for k, v in processor.logos.stats().items()})
+            result_cache = get_result_cache()
+            if result_cache is not None:
+                values.update({f"watermark_result_cache_{k}": v for k, v in result_cache.stats().items()})
+            if pool is not None:
+                values.update({f"watermark_pool_{k}": v for k, v in pool.stats().items()})
+            values.update({f"watermark_admission_{k}": v for k, v in admission.stats().items()})
+            return values
+        start_metrics_server(args.metrics_port, args.host, gauges)
+    
+    demo = create_gradio_interface(pool, admission)
+    demo.queue(max_size=(pool.workers + pool.queue_depth) if pool is not None else None)
+    try:
+        demo.launch(
+            server_name=args.host,
+            server_port=args.port,
+            share=False,
+            prevent_thread_lock=True
+        )
+        if pool_starter is not None:
+            try:
+                logger.info("已启动 %d 个工作进程", pool_starter.result())
+            except Exception as e:
+                # 启动失败的工作进程会在第一个请求时重新创建
+                logger.warning("预先启动工作进程失败：%s", e)
+        logger.info("服务就绪，启动用时 %.1f s", time.perf_counter() - started)
+        notify_ready(f"http://{args.host}:{args.port}")
+        demo.block_thread()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return 0
+
 if __name__ == "__main__":
-    # 创建并启动应用
-    demo = create_gradio_interface()
-    demo.launch(
-        server_name="0.0.0.0",
-        server_port=7860,
-        share=False,
-        debug=True
-    ) 
\ No newline at end of file
+    sys.exit(main())